@@ -1,4 +1,7 @@
 import os
+import tempfile
+
+from celery.schedules import crontab
 # from dotenv import load_dotenv
 
 # Load .env config as enviroment variables
@@ -40,6 +43,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'debug_toolbar.middleware.DebugToolbarMiddleware',
+    'qanda.middleware.MetricsMiddleware',
+    'qanda.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -138,17 +143,43 @@ LOGIN_REDIRECT_URL = 'qanda:home'
 LOGOUT_REDIRECT_URL = 'qanda:home'
 
 # Email config
-EMAIL_BACKEND = "sendgrid_backend.SendgridBackend"
+# Set DJANGO_EMAIL_BACKEND to the locmem or console backend to run locally
+EMAIL_BACKEND = os.getenv('DJANGO_EMAIL_BACKEND',
+                          "sendgrid_backend.SendgridBackend")
 SENDGRID_API_KEY = os.getenv('SENDGRID_KEY')
 SENDGRID_SANDBOX_MODE_IN_DEBUG = False
 EMAIL_USE_TLS = True
 DEFAULT_FROM_EMAIL = 'OffByOne Q/A Team <noreply@offbyone.com>'
 EMAIL_HOST = 'http://localhost:8000'
+# New answer emails are sent in chunks, one backend connection per chunk
+NEW_ANSWER_EMAIL_CHUNK_SIZE = 100
 
 # ElasticSearch config
 ES_INDEX = 'offbyone'
 ES_HOST = 'elasticsearch'
 ES_PORT = '9200'
+# Client connection pool, shared by all the requests of a worker process
+ES_MAXSIZE = int(os.getenv('ES_MAXSIZE', 10))
+ES_TIMEOUT = float(os.getenv('ES_TIMEOUT', 10))
+ES_MAX_RETRIES = int(os.getenv('ES_MAX_RETRIES', 3))
+ES_RETRY_ON_TIMEOUT = True
+ES_SNIFF_ON_START = False
+ES_SNIFF_ON_CONNECTION_FAIL = False
+ES_SNIFFER_TIMEOUT = None
+# In-process stand-in for load tests, see qanda.service.fake_elasticsearch
+ES_FAKE = os.getenv('ES_FAKE', '').lower() in ('1', 'true', 'yes')
+# Questions are indexed in batches of this size by the outbox drain task,
+# up to this many batches per run.
+SEARCH_OUTBOX_BATCH_SIZE = 500
+SEARCH_OUTBOX_MAX_BATCHES = 20
+# Writes pushed during a reindex are recorded until the alias swap, the
+# record expires this long after the last loaded range of a dead reindex.
+SEARCH_REINDEX_CAPTURE_TTL = 60 * 60
+SEARCH_PAGE_SIZE = 10
+# Cached search results are also dropped whenever the index is written to
+SEARCH_CACHE_TTL = 60 * 20
+# Id range compared per step when reconciling the index with the database
+SEARCH_RECONCILE_CHUNK_SIZE = 5000
 
 CACHES = {
     "default": {
@@ -168,11 +199,58 @@ CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'America/Santo_Domingo'
+CELERY_BEAT_SCHEDULE = {
+    'flush-question-views': {
+        'task': 'qanda.tasks.flush_question_views',
+        'schedule': 60.0,
+    },
+    'drain-search-outbox': {
+        'task': 'qanda.tasks.drain_search_outbox',
+        'schedule': 5.0,
+    },
+    'send-hourly-answer-digests': {
+        'task': 'qanda.tasks.send_answer_digests',
+        'schedule': crontab(minute=0),
+        'args': ('hourly',),
+    },
+    'send-daily-answer-digests': {
+        'task': 'qanda.tasks.send_answer_digests',
+        'schedule': crontab(minute=0, hour=8),
+        'args': ('daily',),
+    },
+    'rebuild-reputation': {
+        'task': 'qanda.tasks.rebuild_reputation',
+        'schedule': 60.0 * 60,
+    },
+    'reconcile-search-index': {
+        'task': 'qanda.tasks.reconcile_search_index',
+        'schedule': 60.0 * 60 * 6,
+    },
+}
 
 
 # Default Cache time to live is 15 minutes.
 CACHE_TTL = 60 * 15
 
+# Bearer token required by /metrics, which is closed when it is empty.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# Celery queues whose depth is exported by /metrics.
+METRICS_CELERY_QUEUES = ['celery']
+# Seconds between two flushes of a process' request metrics to Redis.
+METRICS_FLUSH_INTERVAL = 1.0
+
+# Stack sampling of live requests, off unless a rate or token is set.
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(
+    tempfile.gettempdir(), 'offbyone-profiles'))
+PROFILE_INTERVAL = 0.005
+PROFILE_URL_NAMES = ['qanda:home', 'qanda:question_detail',
+                     'qanda:question_search']
+
+# A visitor counts once per question within this window (seconds).
+VIEW_COUNT_WINDOW = 60 * 30
+
 # Debug toolbar config
 INTERNAL_IPS = ['127.0.0.1', ]
 
@@ -57,6 +57,37 @@ class QuestionForm(ColorizedErrorFormMixin, forms.ModelForm):
         return valid
 
 
+class SearchForm(forms.Form):
+    SORT_CHOICES = (
+        ('relevance', 'Relevance'),
+        ('newest', 'Newest'),
+        ('score', 'Score'),
+    )
+    MAX_TAGS = 4
+
+    q = forms.CharField(required=False)
+    tags = forms.CharField(required=False, widget=forms.TextInput(attrs={
+        'class': 'input', 'placeholder': 'Tags, separated by commas'}))
+    created_from = forms.DateField(required=False, widget=forms.DateInput(
+        attrs={'class': 'input', 'type': 'date'}))
+    created_to = forms.DateField(required=False, widget=forms.DateInput(
+        attrs={'class': 'input', 'type': 'date'}))
+    sort = forms.ChoiceField(choices=SORT_CHOICES, required=False)
+
+    def clean_tags(self):
+        # Same normalization as the tags of a new question
+        tags = {tag.strip().lower()
+                for tag in self.cleaned_data['tags'].split(',')}
+        tags.discard('')
+        if len(tags) > self.MAX_TAGS:
+            raise forms.ValidationError(
+                f'You cannot filter on more than {self.MAX_TAGS} tags')
+        return sorted(tags)
+
+    def clean_sort(self):
+        return self.cleaned_data['sort'] or 'relevance'
+
+
 class QuestionVoteForm(forms.ModelForm):
     user = forms.ModelChoiceField(
         widget=forms.HiddenInput,
@@ -193,6 +224,14 @@ class QuestionSubscriptionForm(forms.ModelForm):
         disabled=True
     )
 
+    delivery = forms.ChoiceField(
+        choices=QuestionSubscription.DELIVERY_CHOICES,
+        required=False
+    )
+
     class Meta:
         model = QuestionSubscription
-        fields = ('user', 'question')
+        fields = ('user', 'question', 'delivery')
+
+    def clean_delivery(self):
+        return self.cleaned_data['delivery'] or QuestionSubscription.IMMEDIATE
@@ -1,14 +1,183 @@
-from django.core.management import BaseCommand
+import datetime
+import json
+import os
+import tempfile
+import time
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from qanda.models import Question
-from qanda.service import elasticsearch
+from qanda.service import elasticsearch, search_outbox, search_reconciler
+
+ITERATOR_CHUNK_SIZE = 2000
+DEFAULT_RANGE_SIZE = 10000
+
+
+def load_range(args):
+    """ Index the questions with ids in [start, end), run in a pool worker """
+    index, start_id, end_id = args
+    loaded = 0
+
+    def counted(questions):
+        nonlocal loaded
+        for question in questions:
+            loaded += 1
+            yield question
+
+    # iterator() streams the rows through a server-side cursor
+    questions = Question.objects.filter(pk__gte=start_id, pk__lt=end_id) \
+        .order_by('pk').iterator(chunk_size=ITERATOR_CHUNK_SIZE)
+    all_ok = elasticsearch.bulk_load(counted(questions), index=index)
+    return start_id, loaded, all_ok
+
+
+def parse_since(value):
+    """ An aware datetime from an ISO date or datetime argument """
+    since = parse_datetime(value)
+    if since is None:
+        date = parse_date(value)
+        if date is None:
+            raise CommandError(f'Invalid --since timestamp: {value}')
+        since = datetime.datetime.combine(date, datetime.time.min)
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
 
 
 class Command(BaseCommand):
     help = 'Load all questions into Elasticsearch'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reindex', action='store_true',
+            help='Build a new index and swap the alias to it once loaded')
+        parser.add_argument(
+            '--resume', action='store_true',
+            help='Resume an interrupted --reindex from its checkpoint')
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help='Processes loading id ranges in parallel with --reindex')
+        parser.add_argument(
+            '--range-size', type=int,
+            help=f'Number of ids handed to a worker at a time, defaults to '
+                 f'{DEFAULT_RANGE_SIZE} or to the size of the resumed run')
+        parser.add_argument(
+            '--checkpoint', default=os.path.join(
+                tempfile.gettempdir(), 'offbyone-reindex.json'),
+            help='File recording the id ranges already loaded')
+        parser.add_argument(
+            '--since', type=parse_since,
+            help='Only load questions modified after this date or datetime')
+
     def handle(self, *args, **options):
+        if options['reindex'] or options['resume']:
+            if options['since']:
+                raise CommandError('--since cannot be used with --reindex')
+            return self.reindex(options)
+
+        elasticsearch.ensure_index()
         queryset = Question.objects.all()
-        all_loaded = elasticsearch.bulk_load(queryset)
+        if options['since']:
+            queryset = queryset.filter(modified__gt=options['since'])
+        all_loaded = elasticsearch.bulk_load(
+            queryset.iterator(chunk_size=ITERATOR_CHUNK_SIZE))
+        self.report(all_loaded)
+
+    def reindex(self, options):
+        checkpoint = self.read_checkpoint(options)
+        index = checkpoint['index']
+        reconcile = False
+        if not checkpoint['created']:
+            search_outbox.start_capture()
+            elasticsearch.create_index(index)
+            checkpoint['created'] = True
+            self.write_checkpoint(options['checkpoint'], checkpoint)
+        elif not search_outbox.refresh_capture():
+            # The writes made after the capture expired went unrecorded,
+            # the reconciler finds them once the new index is live
+            self.stdout.write(self.style.WARNING(
+                'The writes made during the reindex expired, the index '
+                'will be reconciled after the swap'))
+            search_outbox.start_capture()
+            reconcile = True
+
+        last_id = Question.objects.aggregate(last=Max('pk'))['last'] or 0
+        range_size = checkpoint['range_size']
+        ranges = [(index, start_id, start_id + range_size)
+                  for start_id in range(0, last_id + 1, range_size)
+                  if start_id not in checkpoint['done']]
+        self.stdout.write(
+            f'Loading {len(ranges)} id ranges into {index} '
+            f'with {options["workers"]} workers')
+
+        # Forked workers must open their own database connections
+        connections.close_all()
+        all_loaded = True
+        loaded = 0
+        started = time.monotonic()
+        with Pool(options['workers']) as pool:
+            for start_id, count, ok in pool.imap_unordered(load_range,
+                                                           ranges):
+                all_loaded = all_loaded and ok
+                loaded += count
+                if ok:
+                    checkpoint['done'].append(start_id)
+                    self.write_checkpoint(options['checkpoint'], checkpoint)
+                    search_outbox.refresh_capture()
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f'{loaded} questions, {loaded / elapsed:.0f} docs/s')
+
+        if not all_loaded:
+            self.report(all_loaded)
+            self.stdout.write(self.style.WARNING(
+                'Index left unswapped, fix the errors and run --resume'))
+            return
+
+        elasticsearch.finish_index(index)
+        elasticsearch.swap_alias(index)
+        # Writes the outbox pushed during the load went to the old index,
+        # including deletions and score changes that leave modified as is
+        replayed = search_outbox.end_capture()
+        search_outbox.enqueue_many(replayed)
+        queued = len(replayed)
+        if reconcile:
+            queued += search_reconciler.reconcile()
+        os.remove(options['checkpoint'])
+        self.stdout.write(self.style.SUCCESS(
+            f'{settings.ES_INDEX} now points to {index}, '
+            f'{queued} questions written meanwhile queued again'))
+
+    def read_checkpoint(self, options):
+        range_size = options['range_size']
+        if options['resume'] and os.path.exists(options['checkpoint']):
+            with open(options['checkpoint']) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            # The done ranges are identified by their start, they only
+            # cover the same ids with the same range size
+            if range_size not in (None, checkpoint['range_size']):
+                raise CommandError(
+                    f'The checkpoint was written with --range-size '
+                    f'{checkpoint["range_size"]}, resume with the same size')
+            return checkpoint
+        now = timezone.now()
+        return {
+            'index': f'{settings.ES_INDEX}-{now:%Y%m%d%H%M%S}',
+            'range_size': range_size or DEFAULT_RANGE_SIZE,
+            'created': False,
+            'done': [],
+        }
+
+    def write_checkpoint(self, path, checkpoint):
+        with open(path, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+
+    def report(self, all_loaded):
         if all_loaded:
             self.stdout.write(self.style.SUCCESS(
                 'Successfully loaded all questions into Elastisearch'))
@@ -0,0 +1,145 @@
+import random
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model as User
+from django.core.management import BaseCommand, CommandError, call_command
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from qanda.models import Answer, Question, QuestionVote, Votable
+from qanda.management.commands.seed_offbyone import WORDS
+
+# Relative weight of each step of the scenario
+SCENARIO = (
+    ('home-top', 20),
+    ('home-newest', 15),
+    ('home-answered', 5),
+    ('question', 35),
+    ('search', 10),
+    ('vote', 10),
+    ('answer', 5),
+)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Replay a weighted browsing scenario and report latency and queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--warmup', type=int, default=100,
+                            help='Requests run first and left out of stats')
+        parser.add_argument('--users', type=int, default=50,
+                            help='Seeded users taking part, logged in')
+        parser.add_argument('--seed', type=int, default=1,
+                            help='Random seed, same seed same requests')
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.users = list(User().objects.order_by('pk')
+                          [:options['users']])
+        self.question_ids = list(Question.objects.order_by('pk')
+                                 .values_list('pk', flat=True))
+        self.answer_ids = list(Answer.objects.order_by('pk')
+                               .values_list('pk', flat=True))
+        if not self.users or not self.question_ids:
+            raise CommandError('No data to replay, run seed_offbyone first')
+        if settings.ES_FAKE:
+            # The fake index lives in this process, fill it before starting
+            call_command('load_questions_into_elastic_search',
+                         stdout=self.stdout)
+
+        self.clients = {}
+        steps, weights = zip(*SCENARIO)
+        plan = self.random.choices(
+            steps, weights, k=options['warmup'] + options['requests'])
+        timings = defaultdict(list)
+        queries = defaultdict(list)
+        for position, step in enumerate(plan):
+            elapsed, count = self.run_step(step)
+            if position >= options['warmup']:
+                timings[step].append(elapsed)
+                queries[step].append(count)
+        self.report(steps, timings, queries)
+
+    def client(self, user):
+        """ A logged in client for `user` """
+        if user.pk not in self.clients:
+            client = Client()
+            client.force_login(user)
+            self.clients[user.pk] = client
+        return self.clients[user.pk]
+
+    def request(self, step, user):
+        """ The (method, url, data) of one request of `step` """
+        question_id = self.random.choice(self.question_ids)
+        if step.startswith('home-'):
+            return 'get', reverse('qanda:home'), {'sort': step[5:]}
+        if step == 'question':
+            return 'get', reverse('qanda:question_detail', kwargs={
+                'pk': question_id, 'title': 'q'}), {}
+        if step == 'search':
+            words = self.random.sample(WORDS, self.random.randint(1, 3))
+            return 'get', reverse('qanda:question_search'), {
+                'q': ' '.join(words)}
+        if step == 'vote':
+            value = self.random.choice((Votable.UP, Votable.DOWN))
+            if connection.vendor != 'postgresql' or not self.answer_ids:
+                # The JSON endpoint upserts with Postgres-only SQL, fall
+                # back to the vote forms
+                return self.form_vote(question_id, user, value)
+            return 'post', reverse('qanda:answer_vote_json', kwargs={
+                'pk': self.random.choice(self.answer_ids)}), {'value': value}
+        return 'post', reverse('qanda:answer-create', kwargs={
+            'question_id': question_id}), {
+            'question': question_id, 'body': 'Load test answer'}
+
+    def form_vote(self, question_id, user, value):
+        data = {'question': question_id, 'value': value}
+        vote = QuestionVote.objects.filter(
+            question=question_id, user=user).first()
+        if vote is None:
+            return 'post', reverse('qanda:question_vote_create', kwargs={
+                'question_id': question_id}), data
+        return 'post', reverse('qanda:question_vote_update', kwargs={
+            'question_id': question_id, 'pk': vote.pk}), data
+
+    def run_step(self, step):
+        user = self.random.choice(self.users)
+        client = self.client(user)
+        method, url, data = self.request(step, user)
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            response = getattr(client, method)(url, data)
+            elapsed = time.perf_counter() - started
+        if response.status_code >= 400:
+            raise CommandError(
+                f'{method.upper()} {url} {data} -> {response.status_code}')
+        return elapsed, len(captured.captured_queries)
+
+    def report(self, steps, timings, queries):
+        self.stdout.write(f'{"step":<16}{"requests":>9}{"p50 ms":>9}'
+                          f'{"p99 ms":>9}{"queries":>9}')
+        everything = []
+        all_queries = []
+        for step in steps:
+            if not timings[step]:
+                continue
+            everything += timings[step]
+            all_queries += queries[step]
+            self.write_row(step, timings[step], queries[step])
+        self.write_row('all', everything, all_queries)
+
+    def write_row(self, name, timings, queries):
+        self.stdout.write(
+            f'{name:<16}{len(timings):>9}'
+            f'{percentile(timings, 0.5) * 1000:>9.1f}'
+            f'{percentile(timings, 0.99) * 1000:>9.1f}'
+            f'{sum(queries) / len(queries):>9.1f}')
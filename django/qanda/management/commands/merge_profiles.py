@@ -0,0 +1,59 @@
+import glob
+import os
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from qanda.service import profiler
+
+
+class Command(BaseCommand):
+    help = ('Merge the request profiles into one folded stacks file per url '
+            'name, ready for flamegraph.pl or speedscope')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=settings.PROFILE_DIR,
+                            help='Directory the profiles were written to')
+        parser.add_argument('--output',
+                            help='Where to write the merged profiles, '
+                                 'defaults to <dir>/merged')
+        parser.add_argument('--top', type=int, default=10,
+                            help='Functions listed per url name')
+        parser.add_argument('--delete', action='store_true',
+                            help='Remove the profiles once merged')
+
+    def handle(self, *args, **options):
+        paths = sorted(glob.glob(os.path.join(
+            options['dir'], f'*{profiler.PROFILE_SUFFIX}')))
+        if not paths:
+            raise CommandError(f'No profiles found in {options["dir"]}')
+        output = options['output'] or os.path.join(options['dir'], 'merged')
+        os.makedirs(output, exist_ok=True)
+
+        grouped = defaultdict(list)
+        for path in paths:
+            grouped[profiler.url_name_of(path)].append(path)
+        for url_name, group in sorted(grouped.items()):
+            stacks = Counter()
+            for path in group:
+                stacks.update(profiler.read_profile(path))
+            merged = os.path.join(output,
+                                  f'{url_name}{profiler.PROFILE_SUFFIX}')
+            with open(merged, 'w') as profile:
+                profile.writelines(f'{stack} {count}\n'
+                                   for stack, count in sorted(stacks.items()))
+            self.report(url_name, len(group), stacks, merged, options['top'])
+            if options['delete']:
+                for path in group:
+                    os.remove(path)
+
+    def report(self, url_name, profiles, stacks, merged, top):
+        samples = sum(stacks.values())
+        self.stdout.write(self.style.SUCCESS(
+            f'{url_name}: {profiles} profiles, {samples} samples -> {merged}'))
+        # Where the samples landed, the widest towers of the flame graph
+        leaves = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rpartition(';')[2]] += count
+        for function, count in leaves.most_common(top):
+            self.stdout.write(f'  {count / samples:>6.1%}  {function}')
@@ -0,0 +1,27 @@
+from django.core.management import BaseCommand
+from django.db.models import Max
+from qanda.models import Answer, Question
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized vote scores and answer counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000,
+                            help='Number of ids reconciled per statement')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        # Answers first so both passes read from the same vote tables
+        for model in (Answer, Question):
+            fixed = self.reconcile(model, chunk_size)
+            self.stdout.write(self.style.SUCCESS(
+                f'Reconciled {fixed} {model._meta.verbose_name_plural}'))
+
+    def reconcile(self, model, chunk_size):
+        last_id = model.objects.aggregate(last=Max('pk'))['last'] or 0
+        fixed = 0
+        for start_id in range(0, last_id + 1, chunk_size):
+            fixed += model.objects.reconcile_scores(
+                start_id, start_id + chunk_size)
+        return fixed
@@ -0,0 +1,36 @@
+from django.core.management import BaseCommand
+from qanda.models import Answer, Comment, Question
+from qanda.service import markup
+
+
+class Command(BaseCommand):
+    help = 'Render the stored HTML of posts rendered by an older renderer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of posts rendered per transaction')
+
+    def handle(self, *args, **options):
+        for model in (Question, Answer, Comment):
+            rendered = self.backfill(model, options['chunk_size'])
+            self.stdout.write(self.style.SUCCESS(
+                f'Rendered {rendered} {model._meta.verbose_name_plural}'))
+
+    def backfill(self, model, chunk_size):
+        stale = model._default_manager \
+            .exclude(body_html_version=markup.RENDERER_VERSION) \
+            .only('pk', 'body', 'body_html', 'body_html_version') \
+            .order_by('pk')
+        rendered = 0
+        last_pk = 0
+        while True:
+            chunk = list(stale.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                return rendered
+            for post in chunk:
+                post.render_body()
+            # bulk_update leaves modified alone and skips the save hooks
+            model._default_manager.bulk_update(
+                chunk, ['body_html', 'body_html_version'])
+            rendered += len(chunk)
+            last_pk = chunk[-1].pk
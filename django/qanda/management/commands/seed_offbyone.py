@@ -0,0 +1,190 @@
+import random
+from datetime import timedelta
+from itertools import accumulate
+
+from django.contrib.auth import get_user_model as User
+from django.contrib.auth.hashers import make_password
+from django.core.management import BaseCommand, call_command
+from django.db import transaction
+from django.utils import timezone
+from qanda import tasks
+from qanda.models import (Answer, AnswerVote, Profile, Question,
+                          QuestionSubscription, QuestionVote, Tag, Votable)
+from qanda.service import markup
+
+WORDS = (
+    'python django query index cache redis celery postgres elastic search '
+    'vote answer model view template migration queue worker latency thread '
+    'process memory socket request response session cookie json schema '
+    'transaction lock deadlock cursor pagination shard replica cluster '
+    'docker compose deploy build test fixture mock profile benchmark'
+).split()
+
+PASSWORD = 'offbyone'
+
+
+def zipf_weights(count, exponent=1.1):
+    """ Cumulative weights making the first items by far the most picked """
+    return list(accumulate(1 / (rank + 1) ** exponent
+                           for rank in range(count)))
+
+
+class Command(BaseCommand):
+    help = 'Fill the database with a skewed synthetic dataset'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--questions', type=int, default=5000)
+        parser.add_argument('--tags', type=int, default=200)
+        parser.add_argument('--answers', type=float, default=3,
+                            help='Average answers per question')
+        parser.add_argument('--votes', type=float, default=8,
+                            help='Average votes per question and per answer')
+        parser.add_argument('--subscriptions', type=float, default=2,
+                            help='Average subscribers per question')
+        parser.add_argument('--seed', type=int, default=1,
+                            help='Random seed, same seed same dataset')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--no-index', action='store_true',
+                            help='Skip loading the questions into search')
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.now = timezone.now()
+
+        with transaction.atomic():
+            users = self.create_users(options['users'])
+            tags = self.create_tags(options['tags'])
+            questions = self.create_questions(options['questions'], users,
+                                              tags)
+            answers = self.create_answers(options['answers'], users,
+                                          questions)
+            self.create_votes(QuestionVote, 'question', options['votes'],
+                              users, questions)
+            self.create_votes(AnswerVote, 'answer', options['votes'],
+                              users, answers)
+            self.create_subscriptions(options['subscriptions'], users,
+                                      questions)
+
+        # bulk_create skipped the signals keeping the counters in sync
+        call_command('reconcile_scores', stdout=self.stdout)
+        tasks.rebuild_reputation()
+        if not options['no_index']:
+            call_command('load_questions_into_elastic_search',
+                         stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded {len(users)} users, {len(questions)} questions and '
+            f'{len(answers)} answers'))
+
+    def skewed(self, population, weights, count=1):
+        return self.random.choices(population, cum_weights=weights, k=count)
+
+    def sentence(self, words):
+        return ' '.join(self.random.choice(WORDS) for _ in range(words))
+
+    def body(self):
+        paragraphs = [self.sentence(self.random.randint(8, 40)).capitalize()
+                      + '.' for _ in range(self.random.randint(1, 4))]
+        return '\n\n'.join(paragraphs)
+
+    def timestamp(self, after=None):
+        """ A time between `after` (a year ago) and now, skewed to recent """
+        after = after or self.now - timedelta(days=365)
+        span = (self.now - after).total_seconds()
+        return after + timedelta(seconds=span * self.random.random() ** 0.5)
+
+    def bulk_create(self, model, objs):
+        """ bulk_create returning the saved rows, with their ids """
+        model.objects.bulk_create(objs, batch_size=self.batch_size)
+        return list(model.objects.order_by('-pk')[:len(objs)])[::-1]
+
+    def publishable(self, model, **fields):
+        body = self.body()
+        created = self.timestamp(fields.pop('after', None))
+        return model(body=body, body_html=markup.render_markdown(body),
+                     body_html_version=markup.RENDERER_VERSION,
+                     created=created, modified=created, **fields)
+
+    def create_users(self, count):
+        password = make_password(PASSWORD)
+        first = User().objects.count()
+        users = self.bulk_create(User(), [
+            User()(username=f'seed{first + i}', password=password,
+                   email=f'seed{first + i}@example.com')
+            for i in range(count)])
+        Profile.objects.bulk_create(
+            [Profile(user=user, email_confirmed=True) for user in users],
+            batch_size=self.batch_size)
+        return users
+
+    def create_tags(self, count):
+        Tag.objects.bulk_create(
+            [Tag(name=f'{self.random.choice(WORDS)}-{i}')
+             for i in range(count)], ignore_conflicts=True,
+            batch_size=self.batch_size)
+        return list(Tag.objects.all())
+
+    def create_questions(self, count, users, tags):
+        user_weights = zipf_weights(len(users))
+        questions = self.bulk_create(Question, [
+            self.publishable(
+                Question, user=self.skewed(users, user_weights)[0],
+                title=self.sentence(self.random.randint(3, 10)).capitalize(),
+                viewed=int(self.random.paretovariate(1.2) * 10))
+            for _ in range(count)])
+        tag_weights = zipf_weights(len(tags))
+        Through = Question.tags.through
+        Through.objects.bulk_create([
+            Through(question_id=question.id, tag_id=tag.id)
+            for question in questions
+            for tag in set(self.skewed(tags, tag_weights,
+                                       self.random.randint(2, 4)))
+        ], batch_size=self.batch_size)
+        return questions
+
+    def create_answers(self, average, users, questions):
+        user_weights = zipf_weights(len(users))
+        answers = []
+        accepted = []
+        for question in questions:
+            count = int(self.random.expovariate(1 / average)) \
+                if average else 0
+            for _ in range(count):
+                answers.append(self.publishable(
+                    Answer, user=self.skewed(users, user_weights)[0],
+                    question=question, after=question.created))
+            if count and self.random.random() < 0.3:
+                accepted.append(answers[-self.random.randint(1, count)])
+        for answer in accepted:
+            answer.accepted = True
+        return self.bulk_create(Answer, answers)
+
+    def create_votes(self, model, field, average, users, objs):
+        votes = []
+        # The most popular posts get most of the votes
+        for obj in objs:
+            count = min(int(self.random.paretovariate(1.5) * average / 3),
+                        len(users))
+            for user in self.random.sample(users, count):
+                value = Votable.UP if self.random.random() < 0.8 \
+                    else Votable.DOWN
+                votes.append(model(user=user, value=value, **{field: obj}))
+        model.objects.bulk_create(votes, batch_size=self.batch_size)
+
+    def create_subscriptions(self, average, users, questions):
+        deliveries = [QuestionSubscription.IMMEDIATE] * 7 + \
+            [QuestionSubscription.HOURLY] * 2 + [QuestionSubscription.DAILY]
+        subscriptions = []
+        for question in questions:
+            count = min(int(self.random.expovariate(1 / average))
+                        if average else 0, len(users))
+            subscribers = {question.user} | set(
+                self.random.sample(users, count))
+            subscriptions.extend(
+                QuestionSubscription(
+                    user=user, question=question,
+                    delivery=self.random.choice(deliveries))
+                for user in subscribers)
+        QuestionSubscription.objects.bulk_create(
+            subscriptions, batch_size=self.batch_size)
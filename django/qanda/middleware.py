@@ -0,0 +1,94 @@
+import hmac
+import logging
+import random
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from qanda.service import metrics, profiler
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsMiddleware(object):
+    """ Time each request and break it down into SQL, search and rendering
+
+        Keep it near the top of MIDDLEWARE so the timings cover the other
+        middlewares too.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics.start_request()
+        started = time.perf_counter()
+        status = 500
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(
+                        connection.execute_wrapper(metrics.record_db))
+                response = self.get_response(request)
+            status = response.status_code
+            return response
+        finally:
+            match = getattr(request, 'resolver_match', None)
+            metrics.end_request(
+                match.view_name if match else 'unresolved', request.method,
+                status, time.perf_counter() - started)
+            metrics.maybe_flush()
+
+    def process_template_response(self, request, response):
+        # Rendered here to be timed, the handler's render() is then a no-op
+        with metrics.timed(metrics.TEMPLATE_SECONDS, 'template_seconds',
+                           template=template_name(response)):
+            response.render()
+        return response
+
+
+def template_name(response):
+    name = response.template_name
+    if isinstance(name, (list, tuple)):
+        name = name[0] if name else ''
+    return getattr(name, 'name', name)
+
+
+class ProfilingMiddleware(object):
+    """ Sample the stacks of a fraction of the requests to PROFILE_DIR
+
+        A request is profiled with probability PROFILE_SAMPLE_RATE, or when
+        it sends PROFILE_TOKEN in the X-Profile header. Only the views in
+        PROFILE_URL_NAMES are profiled, see the merge_profiles command.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.profiler = None
+        response = self.get_response(request)
+        if request.profiler is not None:
+            stacks = request.profiler.stop()
+            try:
+                profiler.write_profile(settings.PROFILE_DIR,
+                                       request.resolver_match.view_name,
+                                       stacks)
+            except OSError:
+                logger.exception('Could not write a request profile')
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.resolver_match.view_name in settings.PROFILE_URL_NAMES \
+                and self.should_profile(request):
+            request.profiler = profiler.SamplingProfiler(
+                interval=settings.PROFILE_INTERVAL).start()
+
+    def should_profile(self, request):
+        token = settings.PROFILE_TOKEN
+        if token and hmac.compare_digest(
+                request.META.get('HTTP_X_PROFILE', '').encode(),
+                token.encode()):
+            return True
+        return random.random() < settings.PROFILE_SAMPLE_RATE
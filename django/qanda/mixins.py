@@ -1,7 +1,4 @@
 from django import forms
-from django.conf import settings
-from django.views.decorators.cache import cache_page
-from django.views.decorators.vary import vary_on_cookie
 
 
 class ColorizedErrorFormMixin(forms.ModelForm):
@@ -17,24 +14,3 @@ class ColorizedErrorFormMixin(forms.ModelForm):
             self.fields[field].widget.attrs.update(
                 {'class': self.fields[field].widget.attrs.get('class', '') +
                  f' {self.error_css_class}'})
-
-
-class CacheVaryOnCookieMixin:
-    """ Mixin caching a single page,
-
-        Subclasses can provide these attribute:
-        `timeout` - cache timeout for this
-    """
-
-    @classmethod
-    def get_timeout(cls):
-        if hasattr(cls, 'timeout'):
-            return cls.timeout
-        return settings.CACHE_TTL
-
-    @classmethod
-    def as_view(cls, *args, **kwargs):
-        view = super().as_view(*args, **kwargs)
-        view = vary_on_cookie(view)
-        view = cache_page(timeout=cls.get_timeout())(view)
-        return view
@@ -1,14 +1,20 @@
+from io import StringIO
+
 from django.contrib.auth import get_user_model as User
-from django.db import models
-from django.db.models import IntegerField, OuterRef, Subquery
-from django.db.models.aggregates import Sum
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import F, IntegerField, OuterRef, Q, Subquery
+from django.db.models.aggregates import Count, Sum
 from django.db.models.functions import Coalesce
-from django.db.models.signals import post_save
+from django.db.models.signals import (m2m_changed, post_delete,
+                                      post_migrate, post_save)
 from django.dispatch import receiver
 from django.shortcuts import reverse
 from django.utils import timezone
-from qanda.service import elasticsearch
+from django.utils.safestring import mark_safe
+from qanda.service import fragment_cache, markup, search_outbox
 from django.conf import settings
+from django.core.mail import EmailMessage
+from django.core.management import call_command
 from django.template.loader import render_to_string
 from qanda import tasks
 
@@ -26,62 +32,216 @@ class VoteManager(models.Manager):
             return self.model(user=vote_user, **{
                 self.vote_model: obj_instance})
 
+    def get_votes_or_unsaved_blank_votes(self, obj_instances, vote_user):
+        ''' Votes of `vote_user` keyed by object id, using a single query '''
+        votes = {
+            getattr(vote, f'{self.vote_model}_id'): vote
+            for vote in self.model.objects.filter(user=vote_user, **{
+                f'{self.vote_model}__in': obj_instances})}
+        for obj_instance in obj_instances:
+            if obj_instance.id not in votes:
+                votes[obj_instance.id] = self.model(user=vote_user, **{
+                    self.vote_model: obj_instance})
+        return votes
+
+    def upsert_vote(self, obj_id, user_id, value):
+        """ Insert or change a vote in one statement, return the delta
+
+            Postgres only. Skips the model signals, so the caller applies
+            the returned score delta. The row is only rewritten when the
+            value changes, and since a vote can only flip between UP and
+            DOWN, a changed vote always moves the score by twice its value.
+        """
+        qn = connection.ops.quote_name
+        meta = self.model._meta
+        table = qn(meta.db_table)
+        obj_column = qn(meta.get_field(self.vote_model).column)
+        user_column = qn(meta.get_field('user').column)
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                INSERT INTO {table} (value, {user_column}, {obj_column},
+                                     voten_on)
+                VALUES (%s, %s, %s, now())
+                ON CONFLICT ({user_column}, {obj_column}) DO UPDATE
+                    SET value = EXCLUDED.value, voten_on = EXCLUDED.voten_on
+                    WHERE {table}.value <> EXCLUDED.value
+                RETURNING xmax = 0
+            """, [value, user_id, obj_id])
+            row = cursor.fetchone()
+        if row is None:
+            return 0
+        inserted, = row
+        return value if inserted else 2 * value
+
+
+def _subquery_total(queryset, group_by, aggregate):
+    """ Coalesced per-row aggregate usable in annotate() and update() """
+    total = queryset.order_by().values(group_by) \
+        .annotate(total=aggregate).values('total')
+    return Coalesce(Subquery(total, output_field=IntegerField()), 0)
+
 
 class QuestionManager(models.Manager):
     def all_with_prefetch_tags(self, filter=None):
         qs = self.get_queryset()
         if filter:
             qs = qs.filter(**filter)
-        return qs.prefetch_related('tags')
+        return qs.select_related('user').prefetch_related('tags')
 
+    # Scores are denormalized columns kept current by the vote signals,
+    # these remain as aliases for the previous annotated querysets.
     def all_with_relations_and_score(self, filter=None):
-        qs = self.all_with_prefetch_tags()
-        if filter:
-            qs = qs.filter(**filter)
-        qs = qs.annotate(score=Coalesce(Sum('questionvote__value'), 0))
-        return qs
+        return self.all_with_prefetch_tags(filter)
 
     def all_with_answer_score(self, filter=None):
-        # Have to resort to subqueries to avoid annotation bug, for more info
-        # check: https://code.djangoproject.com/ticket/10060
-        score = self.get_queryset().annotate(
-            score=Coalesce(
-                Sum('questionvote__value'), 0)) \
-            .filter(pk=OuterRef('pk'))
-        ans_score = self.get_queryset().annotate(
-            ans_score=Coalesce(
-                Sum('answer__answervote__value'), 0)) \
-            .filter(pk=OuterRef('pk'))
-        qs = self.all_with_prefetch_tags()
-        if filter:
-            qs = qs.filter(**filter)
-        qs = qs.annotate(score=Subquery(score.values('score'),
-                                        output_field=IntegerField()),
-                         ans_score=Subquery(ans_score.values('ans_score'),
-                                            output_field=IntegerField()))
-        return qs
+        return self.all_with_prefetch_tags(filter)
+
+    def all_in_order(self, ids):
+        """ Questions with the given ids, in the order of `ids` """
+        questions = self.all_with_prefetch_tags().in_bulk(ids)
+        return [questions[pk] for pk in ids if pk in questions]
+
+    def apply_vote_delta(self, question_id, delta):
+        # The search index sorts on the score, update() skips Question.save
+        transaction.on_commit(lambda: search_outbox.enqueue(question_id))
+        return self.filter(pk=question_id).update(score=F('score') + delta)
+
+    def apply_answer_delta(self, question_id, delta):
+        return self.filter(pk=question_id) \
+            .update(answer_count=F('answer_count') + delta)
+
+    def reconcile_scores(self, start_id, end_id):
+        """ Recompute the denormalized columns for ids in [start, end)
+
+            Returns the number of rows that had drifted.
+        """
+        expected = {
+            'score': _subquery_total(
+                QuestionVote.objects.filter(question=OuterRef('pk')),
+                'question', Sum('value')),
+            'answer_count': _subquery_total(
+                Answer.objects.filter(question=OuterRef('pk')),
+                'question', Count('pk')),
+            'answers_score': _subquery_total(
+                AnswerVote.objects.filter(answer__question=OuterRef('pk')),
+                'answer__question', Sum('value')),
+        }
+        return _reconcile(self.filter(pk__gte=start_id, pk__lt=end_id),
+                          expected)
 
 
 class AnswerManager(models.Manager):
     def all_with_score(self):
-        qs = self.get_queryset() \
-            .annotate(score=Coalesce(Sum('answervote__value'), 0))
-        return qs
+        return self.get_queryset()
+
+    def apply_vote_delta(self, answer_id, delta):
+        answer = self.filter(pk=answer_id)
+        answer.update(score=F('score') + delta)
+        question_id = Subquery(answer.values('question_id'))
+        Question.objects.filter(pk__in=question_id) \
+            .update(answers_score=F('answers_score') + delta)
+        Profile.objects.apply_reputation_delta(
+            Subquery(answer.values('user_id')), delta)
+
+    def reconcile_scores(self, start_id, end_id):
+        expected = {
+            'score': _subquery_total(
+                AnswerVote.objects.filter(answer=OuterRef('pk')),
+                'answer', Sum('value')),
+        }
+        return _reconcile(self.filter(pk__gte=start_id, pk__lt=end_id),
+                          expected)
+
+    def set_accepted(self, answer, accepted):
+        """ Accept or unaccept `answer` without loading the other answers
+
+            Accepting clears the current accepted answer, if any, and then
+            marks this one, two UPDATEs in one transaction. Both go through
+            update(), so the cached pages are invalidated here.
+        """
+        try:
+            self._set_accepted(answer, accepted)
+        except IntegrityError:
+            # A concurrent accept committed first and was invisible to the
+            # clearing UPDATE, run again now that it can be seen and cleared
+            self._set_accepted(answer, accepted)
+        answer.accepted = accepted
+        fragment_cache.bump_on_commit(
+            f'answers:{answer.question_id}', f'question:{answer.question_id}',
+            'answers', 'questions', f'user:{answer.user_id}')
+
+    def _set_accepted(self, answer, accepted):
+        with transaction.atomic():
+            if accepted:
+                self.clear_accepted(answer.question_id, answer.pk)
+            self.filter(pk=answer.pk).update(accepted=accepted)
+
+    def clear_accepted(self, question_id, exclude_id=None):
+        return self.filter(question_id=question_id, accepted=True) \
+            .exclude(pk=exclude_id).update(accepted=False)
+
+
+def _reconcile(queryset, expected):
+    annotations = {f'expected_{f}': e for f, e in expected.items()}
+    drift = Q()
+    for field in expected:
+        drift |= ~Q(**{field: F(f'expected_{field}')})
+    ids = list(queryset.annotate(**annotations).filter(drift)
+               .values_list('pk', flat=True))
+    if ids:
+        queryset.model.objects.filter(pk__in=ids).update(**expected)
+    return len(ids)
 
 
 class Publishable(models.Model):
     user = models.ForeignKey(User(), on_delete=models.CASCADE)
     body = models.TextField()
+    # Markdown rendering of body, done on save instead of on every display
+    body_html = models.TextField(editable=False, default='')
+    body_html_version = models.PositiveSmallIntegerField(
+        editable=False, default=0)
     created = models.DateTimeField(editable=False)
     modified = models.DateTimeField()
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Body the stored body_html was rendered from
+        self._rendered_body = self.__dict__.get('body') if self.pk else None
+
     def save(self, *args, **kwargs):
-        ''' On save, update timestamps '''
+        ''' On save, update timestamps and the rendered body '''
         if not self.id:
             self.created = timezone.now()
         self.modified = timezone.now()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'body' in update_fields:
+            if self.body_html_is_stale():
+                self.render_body()
+                if update_fields is not None:
+                    kwargs['update_fields'] = set(update_fields) | {
+                        'body_html', 'body_html_version'}
         return super(Publishable, self).save(*args, **kwargs)
 
+    def body_html_is_stale(self):
+        return (self.body_html_version != markup.RENDERER_VERSION or
+                self.body != self._rendered_body)
+
+    def render_body(self):
+        self.body_html = markup.render_markdown(self.body)
+        self.body_html_version = markup.RENDERER_VERSION
+        self._rendered_body = self.body
+
+    def get_body_html(self):
+        ''' Stored HTML for the body, re-rendered if the renderer changed '''
+        if self.body_html_is_stale():
+            self.render_body()
+            if self.pk:
+                # Persist without touching modified or re-running save hooks
+                type(self)._default_manager.filter(pk=self.pk).update(
+                    body_html=self.body_html,
+                    body_html_version=self.body_html_version)
+        return mark_safe(self.body_html)
+
     class Meta:
         abstract = True
 
@@ -97,6 +257,24 @@ class Votable(models.Model):
     user = models.ForeignKey(User(), on_delete=models.CASCADE)
     voten_on = models.DateTimeField(auto_now=True)
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Value as stored in the database, used to compute score deltas
+        value = self.__dict__.get('value') if self.pk else None
+        self._persisted_value = int(value or 0)
+
+    def save(self, *args, **kwargs):
+        # The vote and the score updates done by the signals commit together
+        with transaction.atomic():
+            return super().save(*args, **kwargs)
+
+    def pop_value_delta(self):
+        ''' Score change since the last load/save of this vote '''
+        value = int(self.value)
+        delta = value - self._persisted_value
+        self._persisted_value = value
+        return delta
+
     class Meta:
         abstract = True
 
@@ -105,6 +283,10 @@ class Question(Publishable):
     title = models.CharField(max_length=250)
     viewed = models.PositiveIntegerField(default=0)
     tags = models.ManyToManyField('Tag', blank=True)
+    # Denormalized counters, maintained by the vote and answer signals
+    score = models.IntegerField(default=0, editable=False)
+    answer_count = models.IntegerField(default=0, editable=False)
+    answers_score = models.IntegerField(default=0, editable=False)
 
     objects = QuestionManager()
 
@@ -126,6 +308,18 @@ class Question(Publishable):
 
     class Meta:
         ordering = ["-created", ]
+        # Keyset pagination of the homepage sorts, see HomePageView
+        indexes = [
+            models.Index(fields=['-created', '-id'],
+                         name='question_created_id_idx'),
+            models.Index(fields=['-score', '-id'],
+                         name='question_score_id_idx'),
+            models.Index(fields=['-answers_score', '-id'],
+                         name='question_answers_score_id_idx'),
+            # Questions tab of the user page
+            models.Index(fields=['user', '-score'],
+                         name='question_user_score_idx'),
+        ]
 
     def as_elastic_search_dict(self):
         return {
@@ -134,23 +328,42 @@ class Question(Publishable):
             'text': f'{self.title}\n{self.body}',
             'body': self.body,
             'title': self.title,
+            'tags': [tag.name for tag in self.tags.all()],
+            'score': self.score,
             'created': self.created,
             'modified': self.modified,
             'id': self.id,
         }
 
-    # Update the elasticsearch server when the model change
+    # Queue the question for the search indexer once the write commits
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
         super().save(force_insert=force_insert,
                      force_update=force_update, using=using,
                      update_fields=update_fields)
-        elasticsearch.upsert(self)
+        transaction.on_commit(lambda: search_outbox.enqueue(self.id))
+
+
+class TagManager(models.Manager):
+    def get_or_create_many(self, names):
+        """ Tags for `names`, creating the missing ones in one statement """
+        names = set(names)
+        tags = list(self.filter(name__in=names))
+        missing = names - {tag.name for tag in tags}
+        if missing:
+            # A concurrent request may create the same tags, so conflicts
+            # are ignored and the created rows are read back for their ids
+            self.bulk_create([self.model(name=name) for name in missing],
+                             ignore_conflicts=True)
+            tags.extend(self.filter(name__in=missing))
+        return tags
 
 
 class Tag(models.Model):
     name = models.CharField(max_length=40)
 
+    objects = TagManager()
+
     def __str__(self):
         return self.name
 
@@ -161,24 +374,21 @@ class Tag(models.Model):
 class Answer(Publishable):
     question = models.ForeignKey('Question', on_delete=models.CASCADE)
     accepted = models.BooleanField(default=False)
+    score = models.IntegerField(default=0, editable=False)
 
     objects = AnswerManager()
 
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
-        # There can only be one accepted answer per question
-        if self.accepted:
-            try:
-                tmp = Answer.objects.get(
-                    question=self.question.id, accepted=True)
-                if self != tmp:
-                    tmp.accepted = False
-                    tmp.save()
-            except Answer.DoesNotExist:
-                pass
         is_new = self._state.adding or force_insert
-        super().save(force_insert=force_insert, force_update=force_update,
-                     using=using, update_fields=update_fields)
+        with transaction.atomic():
+            # There can only be one accepted answer per question, enforced
+            # by the answer_one_accepted_per_question index
+            if self.accepted:
+                Answer.objects.clear_accepted(self.question_id, self.pk)
+            super().save(force_insert=force_insert,
+                         force_update=force_update, using=using,
+                         update_fields=update_fields)
         if is_new:
             self.send_answer_email()
 
@@ -187,6 +397,21 @@ class Answer(Publishable):
 
     class Meta:
         ordering = ["-accepted", ]
+        indexes = [
+            # Answers of a question in display order
+            models.Index(fields=['question', '-accepted', '-score'],
+                         name='answer_question_accepted_idx'),
+            # Latest answers on the homepage
+            models.Index(fields=['-created'], name='answer_created_idx'),
+            # Answers tab of the user page
+            models.Index(fields=['user', '-score'],
+                         name='answer_user_score_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['question'], condition=Q(accepted=True),
+                name='answer_one_accepted_per_question'),
+        ]
 
     def __str__(self):
         return f'{self.user} | {self.question.title}'
@@ -207,6 +432,11 @@ class QuestionVote(Votable):
 
     class Meta:
         unique_together = ('user', 'question')
+        # Covers the score sums, which then never read the table
+        indexes = [
+            models.Index(fields=['question', 'value'],
+                         name='qvote_question_value_idx'),
+        ]
 
 
 class AnswerVote(Votable):
@@ -216,21 +446,38 @@ class AnswerVote(Votable):
 
     class Meta:
         unique_together = ('user', 'answer')
+        indexes = [
+            models.Index(fields=['answer', 'value'],
+                         name='avote_answer_value_idx'),
+        ]
 
 
 class ProfileManager(models.Manager):
-    # Score for an user is based on the sum of upvotes of all their answers.
-    def all_with_user_score(self):
-        qs = self.get_queryset()
-        qs = qs.annotate(score=Coalesce(
-            Sum('user__answer__answervote__value'), 0))
-        return qs
+    # Reputation for an user is the sum of the votes of all their answers.
+    def top_by_reputation(self, limit):
+        return self.get_queryset().select_related('user') \
+            .order_by('-reputation')[:limit]
+
+    def apply_reputation_delta(self, user_ids, delta):
+        return self.filter(user__in=user_ids) \
+            .update(reputation=F('reputation') + delta)
+
+    def reconcile_reputation(self, start_id, end_id):
+        expected = {
+            'reputation': _subquery_total(
+                AnswerVote.objects.filter(answer__user=OuterRef('user')),
+                'answer__user', Sum('value')),
+        }
+        return _reconcile(self.filter(pk__gte=start_id, pk__lt=end_id),
+                          expected)
 
 
 class Profile(models.Model):
     user = models.OneToOneField(
         User(), on_delete=models.CASCADE, primary_key=True)
     email_confirmed = models.BooleanField(default=False)
+    # Denormalized, maintained by the answer vote signals
+    reputation = models.IntegerField(default=0, editable=False, db_index=True)
 
     objects = ProfileManager()
 
@@ -250,24 +497,145 @@ class QuestionSubscriptionManager(models.Manager):
 
 
 class QuestionSubscription(models.Model):
+    IMMEDIATE = 'immediate'
+    HOURLY = 'hourly'
+    DAILY = 'daily'
+    DELIVERY_CHOICES = (
+        (IMMEDIATE, 'Every answer'),
+        (HOURLY, 'Hourly digest'),
+        (DAILY, 'Daily digest'),
+    )
     user = models.ForeignKey(User(), on_delete=models.CASCADE)
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
+    delivery = models.CharField(max_length=10, choices=DELIVERY_CHOICES,
+                                default=IMMEDIATE)
 
     objects = QuestionSubscriptionManager()
 
     ANSWER_EMAIL_TEMPLATE = 'email/new_answer.html'
+    ANSWER_EMAIL_GREETING = 'Hi {},\n'
 
-    def email_new_answer(self):
-        subject = f"New answer on '{self.question.title}'"
-        message = render_to_string(self.ANSWER_EMAIL_TEMPLATE, {
+    @classmethod
+    def new_answer_emails(cls, question, subscriptions):
+        """ One email per subscription, the shared body is rendered once """
+        subject = f"New answer on '{question.title}'"
+        body = render_to_string(cls.ANSWER_EMAIL_TEMPLATE, {
             'domain': settings.EMAIL_HOST,
-            'user': self.user,
-            'question': self.question
+            'question': question
         })
-        tasks.send_email.delay(self.user.id, subject, message)
+        return [
+            EmailMessage(
+                subject, cls.ANSWER_EMAIL_GREETING.format(sub.user.username) +
+                body, to=[sub.user.email])
+            for sub in subscriptions if sub.user.email]
 
     def __str__(self):
         return f'{self.user} | {self.question.title}'
 
     class Meta:
         unique_together = ('user', 'question')
+        # Subscribers of a question walked in id order by the email tasks
+        indexes = [
+            models.Index(fields=['question', 'id'],
+                         name='subscription_question_idx'),
+        ]
+
+
+@receiver(post_delete, sender=Question)
+def remove_question_from_search(sender, instance, **kwargs):
+    question_id = instance.id
+    transaction.on_commit(lambda: search_outbox.enqueue(question_id))
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def bump_question_versions(sender, instance, **kwargs):
+    fragment_cache.bump_on_commit(
+        f'question:{instance.id}', 'questions', f'user:{instance.user_id}')
+
+
+@receiver(m2m_changed, sender=Question.tags.through)
+def bump_question_tags_versions(sender, instance, action, **kwargs):
+    if action.startswith('post_') and isinstance(instance, Question):
+        fragment_cache.bump_on_commit(f'question:{instance.id}', 'questions')
+        question_id = instance.id
+        transaction.on_commit(lambda: search_outbox.enqueue(question_id))
+
+
+def bump_question_vote_versions(vote):
+    fragment_cache.bump_on_commit(
+        f'question:{vote.question_id}', 'questions',
+        f'user:{vote.question.user_id}')
+
+
+def bump_answer_vote_versions(vote):
+    fragment_cache.bump_on_commit(
+        f'answers:{vote.answer.question_id}', 'answers', 'questions',
+        'leaderboard', f'user:{vote.answer.user_id}')
+
+
+@receiver(post_save, sender=QuestionVote)
+def add_question_vote_to_score(sender, instance, **kwargs):
+    delta = instance.pop_value_delta()
+    if delta:
+        Question.objects.apply_vote_delta(instance.question_id, delta)
+        bump_question_vote_versions(instance)
+
+
+@receiver(post_delete, sender=QuestionVote)
+def remove_question_vote_from_score(sender, instance, **kwargs):
+    if instance._persisted_value:
+        Question.objects.apply_vote_delta(
+            instance.question_id, -instance._persisted_value)
+        bump_question_vote_versions(instance)
+
+
+@receiver(post_save, sender=AnswerVote)
+def add_answer_vote_to_score(sender, instance, **kwargs):
+    delta = instance.pop_value_delta()
+    if delta:
+        Answer.objects.apply_vote_delta(instance.answer_id, delta)
+        bump_answer_vote_versions(instance)
+
+
+@receiver(post_delete, sender=AnswerVote)
+def remove_answer_vote_from_score(sender, instance, **kwargs):
+    if instance._persisted_value:
+        Answer.objects.apply_vote_delta(
+            instance.answer_id, -instance._persisted_value)
+        bump_answer_vote_versions(instance)
+
+
+@receiver(post_save, sender=Answer)
+def add_answer_to_count(sender, instance, created, **kwargs):
+    if created:
+        Question.objects.apply_answer_delta(instance.question_id, 1)
+
+
+# The answer's votes are deleted first by the cascade, so their own signals
+# already took them out of the question's answers_score.
+@receiver(post_delete, sender=Answer)
+def remove_answer_from_count(sender, instance, **kwargs):
+    Question.objects.apply_answer_delta(instance.question_id, -1)
+
+
+# Rows written before a denormalized column existed or changed type hold the
+# column default, the deltas applied by the signals are only right on top of
+# the real totals.
+@receiver(post_migrate)
+def backfill_counters(sender, verbosity=1, **kwargs):
+    if sender.name != 'qanda':
+        return
+    call_command('reconcile_scores',
+                 stdout=None if verbosity else StringIO())
+    tasks.rebuild_reputation()
+
+
+@receiver(post_save, sender=Answer)
+@receiver(post_delete, sender=Answer)
+def bump_answer_versions(sender, instance, **kwargs):
+    # The answer count is shown on the profile of the question's owner
+    fragment_cache.bump_on_commit(
+        f'answers:{instance.question_id}', f'question:{instance.question_id}',
+        'answers', 'questions', f'user:{instance.user_id}',
+        f'user:{instance.question.user_id}')
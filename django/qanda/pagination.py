@@ -0,0 +1,97 @@
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+def encode_key(key):
+    """ An opaque, url safe cursor for a list of sort values """
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_key(cursor):
+    """ The list of sort values of a cursor, None if it is not valid """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError, TypeError):
+        return None
+    return key if isinstance(key, list) else None
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class KeysetPaginator:
+    """ Paginates a queryset on (sort_field, pk), both descending
+
+        Pages are fetched with a `WHERE (sort_field, pk) < cursor` condition
+        instead of an OFFSET, and no COUNT is run, so every page costs the
+        same index range scan. It needs an index on (sort_field, pk).
+    """
+
+    def __init__(self, queryset, sort_field, per_page):
+        self.queryset = queryset
+        self.sort_field = sort_field
+        self.per_page = per_page
+        self.field = queryset.model._meta.get_field(sort_field)
+
+    def encode_cursor(self, obj):
+        return encode_key([self.field.value_to_string(obj), obj.pk])
+
+    def decode_cursor(self, cursor):
+        """ (sort value, pk) from a cursor, None if it is not valid """
+        try:
+            value, pk = decode_key(cursor)
+            return self.field.to_python(value), int(pk)
+        except (ValueError, TypeError, ValidationError):
+            return None
+
+    def page(self, after=None, before=None):
+        """ The page after the `after` cursor, or before `before`
+
+            Without a valid cursor the first page is returned.
+        """
+        field = self.sort_field
+        before_key = self.decode_cursor(before) if before else None
+        if before_key:
+            value, pk = before_key
+            qs = self.queryset.order_by(field, 'pk').filter(
+                Q(**{f'{field}__gt': value}) |
+                Q(**{field: value, 'pk__gt': pk}))
+            object_list = list(qs[:self.per_page + 1])
+            has_more = len(object_list) > self.per_page
+            object_list = object_list[:self.per_page][::-1]
+            return KeysetPage(
+                object_list,
+                next_cursor=self._cursor_at(object_list, -1),
+                previous_cursor=self._cursor_at(object_list, 0)
+                if has_more else None)
+
+        qs = self.queryset.order_by(f'-{field}', '-pk')
+        key = self.decode_cursor(after) if after else None
+        if key:
+            value, pk = key
+            qs = qs.filter(Q(**{f'{field}__lt': value}) |
+                           Q(**{field: value, 'pk__lt': pk}))
+        object_list = list(qs[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        return KeysetPage(
+            object_list,
+            next_cursor=self._cursor_at(object_list, -1) if has_more else None,
+            previous_cursor=self._cursor_at(object_list, 0) if key else None)
+
+    def _cursor_at(self, object_list, index):
+        return self.encode_cursor(object_list[index]) if object_list else None
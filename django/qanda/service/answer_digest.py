@@ -0,0 +1,104 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model as User
+from django.core.mail import EmailMessage, get_connection
+from django.template.loader import render_to_string
+from django_redis import get_redis_connection
+
+# Per delivery mode, the set of users with pending events and, per user, a
+# hash of question id -> new answers since their last digest. A digest user
+# costs one small hash however many answers are posted.
+DIGEST_USERS_KEY = 'qanda:digest:{}:users'
+DIGEST_EVENTS_KEY = 'qanda:digest:{}:{}'
+
+DIGEST_EMAIL_TEMPLATE = 'email/answer_digest.html'
+
+
+def add_new_answer(question_id, subscribers):
+    """ Record a new answer for `subscribers`, (user id, delivery) pairs """
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for user_id, delivery in subscribers:
+        pipe.hincrby(DIGEST_EVENTS_KEY.format(delivery, user_id),
+                     question_id, 1)
+        pipe.sadd(DIGEST_USERS_KEY.format(delivery), user_id)
+    pipe.execute()
+
+
+def pop_events(delivery, count):
+    """ Take the pending events of up to `count` users
+
+        Returns {user_id: {question_id: new answers}}, or None once no user
+        has pending events left.
+    """
+    redis = get_redis_connection('default')
+    user_ids = redis.spop(DIGEST_USERS_KEY.format(delivery), count)
+    if not user_ids:
+        return None
+    events = {}
+    for user_id in user_ids:
+        key = DIGEST_EVENTS_KEY.format(delivery, int(user_id))
+        pipe = redis.pipeline()
+        pipe.hgetall(key)
+        pipe.delete(key)
+        pending, _ = pipe.execute()
+        if pending:
+            events[int(user_id)] = {int(question_id): int(answers)
+                                    for question_id, answers
+                                    in pending.items()}
+    return events
+
+
+def restore_events(delivery, events):
+    """ Put back events taken by pop_events that could not be sent """
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for user_id, questions in events.items():
+        for question_id, answers in questions.items():
+            pipe.hincrby(DIGEST_EVENTS_KEY.format(delivery, user_id),
+                         question_id, answers)
+        pipe.sadd(DIGEST_USERS_KEY.format(delivery), user_id)
+    pipe.execute()
+
+
+def build_emails(delivery, events):
+    from qanda.models import Question
+
+    users = User().objects.in_bulk(list(events))
+    questions = Question.objects.in_bulk(
+        list({question_id for user_questions in events.values()
+              for question_id in user_questions}))
+    messages = []
+    for user_id, user_questions in events.items():
+        user = users.get(user_id)
+        new_answers = [(questions[question_id], answers)
+                       for question_id, answers in user_questions.items()
+                       if question_id in questions]
+        if not user or not user.email or not new_answers:
+            continue
+        message = render_to_string(DIGEST_EMAIL_TEMPLATE, {
+            'domain': settings.EMAIL_HOST,
+            'user': user,
+            'delivery': delivery,
+            'new_answers': new_answers,
+        })
+        messages.append(EmailMessage(
+            'New answers on your subscribed questions', message,
+            to=[user.email]))
+    return messages
+
+
+def send_digests(delivery):
+    """ Email every user with pending events one digest, in chunks
+
+        Returns the number of emails sent.
+    """
+    sent = 0
+    while True:
+        events = pop_events(delivery, settings.NEW_ANSWER_EMAIL_CHUNK_SIZE)
+        if events is None:
+            return sent
+        try:
+            messages = build_emails(delivery, events)
+            with get_connection() as connection:
+                sent += connection.send_messages(messages) or 0
+        except Exception:
+            restore_events(delivery, events)
+            raise
@@ -1,58 +1,272 @@
+import datetime
 import logging
+import os
+import threading
+from collections import namedtuple
+from itertools import chain, islice
 
 from django.conf import settings
+from django.db.models import prefetch_related_objects
+from django.utils import timezone
 from elasticsearch6 import Elasticsearch, TransportError
-from elasticsearch6.helpers import streaming_bulk
+from elasticsearch6.helpers import scan, streaming_bulk
+from qanda.service import metrics, search_cache
 
 FAILED_TO_LOAD_ERROR = 'Failed to load {}: {!r}'
 
 logger = logging.getLogger(__name__)
 
+# `next_after` and `previous_before` are the sort values to search after to
+# get the neighbouring pages, None when there is no such page
+SearchResults = namedtuple('SearchResults', [
+    'ids', 'total', 'next_after', 'previous_before'])
+
+# Explicit types so tags are matched whole and score and dates can be sorted
+# on, an index created by dynamic mapping needs a --reindex to get them
+QUESTION_MAPPING = {
+    'doc': {
+        'properties': {
+            'id': {'type': 'integer'},
+            'text': {'type': 'text'},
+            'title': {'type': 'text'},
+            'body': {'type': 'text'},
+            'tags': {'type': 'keyword'},
+            'score': {'type': 'integer'},
+            'created': {'type': 'date'},
+            'modified': {'type': 'date'},
+        }
+    }
+}
+
+# Sorts of the search results, all ending with the id so that every hit has
+# a distinct sort key to search after
+SEARCH_SORTS = {
+    'relevance': [{'_score': 'desc'}, {'id': 'desc'}],
+    'newest': [{'created': 'desc'}, {'id': 'desc'}],
+    'score': [{'score': 'desc'}, {'id': 'desc'}],
+}
+
+# Questions whose tags are fetched together while building documents
+DOCUMENT_CHUNK_SIZE = 500
+
+# One client (and urllib3 pool) per process. The owning pid is kept so a
+# client inherited through fork (gunicorn and celery prefork) is never reused
+# by the child, whose copies of the parent's sockets are not safe to share.
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
 
 def get_client():
-    return Elasticsearch(hosts=[
-        {'host': settings.ES_HOST, 'port': settings.ES_PORT}
-    ])
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = _build_client()
+                _client_pid = pid
+    return _client
+
+
+def _build_client():
+    if settings.ES_FAKE:
+        from qanda.service.fake_elasticsearch import FakeElasticsearch
+        return FakeElasticsearch()
+    return Elasticsearch(
+        hosts=[{'host': settings.ES_HOST, 'port': settings.ES_PORT}],
+        maxsize=settings.ES_MAXSIZE,
+        timeout=settings.ES_TIMEOUT,
+        max_retries=settings.ES_MAX_RETRIES,
+        retry_on_timeout=settings.ES_RETRY_ON_TIMEOUT,
+        sniff_on_start=settings.ES_SNIFF_ON_START,
+        sniff_on_connection_fail=settings.ES_SNIFF_ON_CONNECTION_FAIL,
+        sniffer_timeout=settings.ES_SNIFFER_TIMEOUT,
+    )
+
+
+def as_documents(questions):
+    """ Index documents of `questions`, prefetching their tags in chunks
 
+        prefetch_related is ignored by QuerySet.iterator(), so the loaders
+        streaming questions would otherwise run a query per question.
+    """
+    questions = iter(questions)
+    while True:
+        chunk = list(islice(questions, DOCUMENT_CHUNK_SIZE))
+        if not chunk:
+            return
+        prefetch_related_objects(chunk, 'tags')
+        for question in chunk:
+            yield question.as_elastic_search_dict()
 
-def bulk_load(questions):
+
+@metrics.timed_es('bulk_load')
+def bulk_load(questions, index=None):
     all_ok = True
-    es_questions = (q.as_elastic_search_dict() for q in questions)
+    es_questions = as_documents(questions)
     for ok, result in streaming_bulk(get_client(), es_questions,
-                                     index=settings.ES_INDEX,
+                                     index=index or settings.ES_INDEX,
                                      raise_on_error=False,):
         if not ok:
             all_ok = False
             action, result = result.popitem()
             logger.error(FAILED_TO_LOAD_ERROR.format(result['_id'], result))
+    search_cache.bump_generation()
     return all_ok
 
 
-def search_for_questions(query):
+@metrics.timed_es('bulk_sync')
+def bulk_sync(questions, deleted_ids=()):
+    """ Index `questions` and delete `deleted_ids`, return the failed ids """
+    failed_ids = set()
+    actions = chain(
+        as_documents(questions),
+        ({'_op_type': 'delete', '_type': 'doc', '_id': question_id}
+         for question_id in deleted_ids))
+    # wait_for makes the writes searchable before the cached search results
+    # are invalidated, so they cannot be re-cached from a stale index
+    for ok, result in streaming_bulk(get_client(), actions,
+                                     index=settings.ES_INDEX,
+                                     refresh='wait_for',
+                                     raise_on_error=False,
+                                     raise_on_exception=False):
+        if not ok:
+            action, result = result.popitem()
+            # Deleting a document that was never indexed is not a failure
+            if action == 'delete' and result.get('status') == 404:
+                continue
+            failed_ids.add(int(result['_id']))
+            logger.error(FAILED_TO_LOAD_ERROR.format(result['_id'], result))
+    search_cache.bump_generation()
+    return failed_ids
+
+
+@metrics.timed_es('create_index')
+def create_index(name):
+    """ Create an index tuned for a bulk load, see finish_index """
+    get_client().indices.create(index=name, body={
+        'settings': {'refresh_interval': '-1'},
+        'mappings': QUESTION_MAPPING,
+    })
+
+
+@metrics.timed_es('ensure_index')
+def ensure_index():
+    """ Create ES_INDEX with the question mapping unless it exists """
     client = get_client()
-    result = client.search(index=settings.ES_INDEX, body={
-        'query': {
-            'match': {
-                'text': query
-            }
-        }
+    if not client.indices.exists(index=settings.ES_INDEX):
+        client.indices.create(index=settings.ES_INDEX,
+                              body={'mappings': QUESTION_MAPPING})
+
+
+@metrics.timed_es('finish_index')
+def finish_index(name):
+    """ Restore the normal refresh of a bulk loaded index """
+    client = get_client()
+    client.indices.put_settings(index=name, body={
+        'index': {'refresh_interval': None}
     })
-    return (h['_source'] for h in result['hits']['hits'])
+    client.indices.refresh(index=name)
 
 
-def upsert(question_model):
+@metrics.timed_es('swap_alias')
+def swap_alias(index):
+    """ Atomically point the ES_INDEX alias at `index`
+
+        The indices the alias pointed to are left in place, an ES_INDEX
+        concrete index from before aliases were used is deleted.
+    """
     client = get_client()
-    question_dict = question_model.as_elastic_search_dict()
-    doc_type = question_dict['_type']
-    del question_dict['_id']
-    del question_dict['_type']
-    response = client.update(
-        settings.ES_INDEX,
-        doc_type,
-        id=question_model.id,
-        body={
-            'doc': question_dict,
-            'doc_as_upsert': True
-        }
-    )
-    return response
+    alias = settings.ES_INDEX
+    actions = [{'add': {'index': index, 'alias': alias}}]
+    if client.indices.exists_alias(name=alias):
+        for old_index in client.indices.get_alias(name=alias):
+            actions.append({'remove': {'index': old_index, 'alias': alias}})
+    elif client.indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+    client.indices.update_aliases(body={'actions': actions})
+    search_cache.bump_generation()
+
+
+def scan_indexed(start_id, end_id=None):
+    """ Yield (id, (modified, score)) of the indexed questions in range
+
+        `end_id` is exclusive, None scans to the last indexed question.
+    """
+    id_range = {'gte': start_id}
+    if end_id is not None:
+        id_range['lt'] = end_id
+    hits = scan(get_client(), index=settings.ES_INDEX, query={
+        'query': {'range': {'id': id_range}},
+        '_source': ['id', 'modified', 'score'],
+    }, size=settings.SEARCH_RECONCILE_CHUNK_SIZE)
+    for hit in hits:
+        source = hit['_source']
+        yield source['id'], (source.get('modified'), source.get('score'))
+
+
+def reverse_sort(sort):
+    return [{field: 'asc' if order == 'desc' else 'desc'}
+            for entry in sort for field, order in entry.items()]
+
+
+@metrics.timed_es('search_for_questions')
+def day_start(date):
+    """ Aware midnight starting `date` in the current time zone """
+    return timezone.make_aware(
+        datetime.datetime.combine(date, datetime.time.min))
+
+
+def search_for_questions(query, tags=(), created_from=None, created_to=None,
+                         sort='relevance', after=None, before=None,
+                         size=None):
+    """ A page of the questions matching `query` and the filters
+
+        Pages are walked with search_after from the sort values of the
+        last hit (`after`) or backwards from the first one (`before`), so
+        a deep page costs the cluster no more than the first one. Each tag
+        of `tags` must be on the question, `created_from` and
+        `created_to` are inclusive dates in the current time zone.
+    """
+    size = size or settings.SEARCH_PAGE_SIZE
+    filters = [{'term': {'tags': tag}} for tag in tags]
+    # Sent with their offset, ES would read bare dates as UTC days
+    created = {}
+    if created_from:
+        created['gte'] = day_start(created_from).isoformat()
+    if created_to:
+        created['lt'] = day_start(
+            created_to + datetime.timedelta(days=1)).isoformat()
+    if created:
+        filters.append({'range': {'created': created}})
+    order = SEARCH_SORTS[sort]
+    body = {
+        'query': {
+            'bool': {
+                'must': {'match': {'text': query}},
+                'filter': filters,
+            }
+        },
+        # The page is rendered from the database, only the ids are needed
+        '_source': ['id'],
+        # One more hit than the page tells if there is a page past it
+        'size': size + 1,
+        'sort': reverse_sort(order) if before else order,
+    }
+    if before or after:
+        body['search_after'] = before or after
+    result = get_client().search(index=settings.ES_INDEX, body=body)
+
+    hits = result['hits']['hits']
+    has_more = len(hits) > size
+    hits = hits[:size]
+    if before:
+        hits.reverse()
+        has_next, has_previous = True, has_more
+    else:
+        has_next, has_previous = has_more, after is not None
+    return SearchResults(
+        ids=[h['_source']['id'] for h in hits],
+        total=result['hits']['total'],
+        next_after=hits[-1]['sort'] if hits and has_next else None,
+        previous_before=hits[0]['sort'] if hits and has_previous else None)
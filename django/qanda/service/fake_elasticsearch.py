@@ -0,0 +1,323 @@
+import json
+import re
+import threading
+import uuid
+from itertools import chain
+
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import utc
+from elasticsearch6 import NotFoundError, RequestError
+from elasticsearch6.serializer import JSONSerializer
+
+# An in-process stand-in for the few Elasticsearch APIs qanda uses, enabled
+# with the ES_FAKE setting. Documents live in this process only, so it is
+# meant for load tests and local runs, not for anything sharing an index.
+_indices = {}
+_aliases = {}
+_scrolls = {}
+_lock = threading.RLock()
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def reset():
+    """ Drop every index, alias and scroll """
+    with _lock:
+        _indices.clear()
+        _aliases.clear()
+        _scrolls.clear()
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(str(text).lower())
+
+
+class FakeTransport(object):
+    serializer = JSONSerializer()
+
+
+class FakeIndices(object):
+    def create(self, index, body=None, **kwargs):
+        with _lock:
+            if index in _indices or index in _aliases:
+                raise RequestError(400, 'resource_already_exists_exception',
+                                   {'index': index})
+            _indices[index] = {}
+        return {'acknowledged': True, 'index': index}
+
+    def exists(self, index, **kwargs):
+        return index in _indices or index in _aliases
+
+    def exists_alias(self, name, **kwargs):
+        return name in _aliases
+
+    def get_alias(self, name, **kwargs):
+        if name not in _aliases:
+            raise NotFoundError(404, 'alias_not_found', {'alias': name})
+        return {index: {'aliases': {name: {}}} for index in _aliases[name]}
+
+    def update_aliases(self, body, **kwargs):
+        with _lock:
+            for action in body['actions']:
+                (op, params), = action.items()
+                if op == 'add':
+                    _aliases.setdefault(params['alias'], set()) \
+                        .add(params['index'])
+                elif op == 'remove':
+                    _aliases.get(params['alias'], set()) \
+                        .discard(params['index'])
+                elif op == 'remove_index':
+                    _indices.pop(params['index'], None)
+            for alias in [a for a, indices in _aliases.items() if not indices]:
+                del _aliases[alias]
+        return {'acknowledged': True}
+
+    def put_settings(self, body, index=None, **kwargs):
+        return {'acknowledged': True}
+
+    def refresh(self, index=None, **kwargs):
+        return {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+
+class FakeElasticsearch(object):
+    """ Client implementing index, bulk, update, search and scroll """
+
+    def __init__(self, *args, **kwargs):
+        self.transport = FakeTransport()
+        self.indices = FakeIndices()
+
+    def _read_indices(self, index):
+        if index in _aliases:
+            return [_indices[name] for name in _aliases[index]]
+        if index not in _indices:
+            raise NotFoundError(404, 'index_not_found_exception',
+                                {'index': index})
+        return [_indices[index]]
+
+    def _write_index(self, index):
+        if index in _aliases:
+            index, = _aliases[index]
+        return _indices.setdefault(index, {})
+
+    def _store(self, index, doc_id, source):
+        # Round trip through JSON like a real index, dates become strings
+        source = json.loads(self.transport.serializer.dumps(source))
+        self._write_index(index)[str(doc_id)] = source
+
+    def bulk(self, body, index=None, **kwargs):
+        lines = [json.loads(line) for line in body.splitlines() if line]
+        items = []
+        with _lock:
+            lines = iter(lines)
+            for action in lines:
+                (op, meta), = action.items()
+                target = meta.get('_index', index)
+                doc_id = str(meta['_id'])
+                if op == 'delete':
+                    docs = self._write_index(target)
+                    status = 200 if docs.pop(doc_id, None) else 404
+                else:
+                    source = next(lines)
+                    if op == 'update':
+                        docs = self._write_index(target)
+                        source = dict(docs.get(doc_id, {}), **source['doc'])
+                    self._store(target, doc_id, source)
+                    status = 201
+                items.append({op: {'_index': target, '_type': 'doc',
+                                   '_id': doc_id, 'status': status}})
+        return {'took': 0, 'errors': False, 'items': items}
+
+    def update(self, index, doc_type, id, body, **kwargs):
+        with _lock:
+            docs = self._write_index(index)
+            self._store(index, id,
+                        dict(docs.get(str(id), {}), **body['doc']))
+        return {'_index': index, '_id': str(id), 'result': 'updated'}
+
+    def search(self, index=None, body=None, scroll=None, size=None,
+               **kwargs):
+        body = body or {}
+        with _lock:
+            docs = list(chain.from_iterable(
+                d.items() for d in self._read_indices(index)))
+        hits = []
+        for doc_id, source in docs:
+            score = match_query(body.get('query', {'match_all': {}}), source)
+            if score is not None:
+                hits.append({'_index': index, '_type': 'doc', '_id': doc_id,
+                             '_score': score, '_source': source})
+        hits = sort_hits(hits, body.get('sort'))
+        if 'search_after' in body:
+            after = list(body['search_after'])
+            hits = [hit for hit in hits
+                    if sort_key(hit, body.get('sort')) > sort_key(
+                        {'_sort': after}, body.get('sort'), raw=True)]
+        total = len(hits)
+        size = body.get('size', size if size is not None else 10)
+        offset = body.get('from', 0)
+        result = {'took': 0, 'timed_out': False,
+                  '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+                  'hits': {'total': total, 'max_score': None, 'hits': []}}
+        if scroll:
+            scroll_id = uuid.uuid4().hex
+            _scrolls[scroll_id] = (hits, size, body.get('_source'))
+            result['_scroll_id'] = scroll_id
+            page = self._next_scroll_page(scroll_id)
+        else:
+            page = hits[offset:offset + size]
+        result['hits']['hits'] = [
+            filter_source(hit, body.get('_source')) for hit in page]
+        return result
+
+    def _next_scroll_page(self, scroll_id):
+        hits, size, _ = _scrolls[scroll_id]
+        page, rest = hits[:size], hits[size:]
+        _scrolls[scroll_id] = (rest, size, _scrolls[scroll_id][2])
+        return page
+
+    def scroll(self, scroll_id=None, scroll=None, body=None, **kwargs):
+        if scroll_id not in _scrolls:
+            raise NotFoundError(404, 'search_context_missing_exception', {})
+        source = _scrolls[scroll_id][2]
+        page = self._next_scroll_page(scroll_id)
+        return {'_scroll_id': scroll_id,
+                '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+                'hits': {'hits': [filter_source(hit, source)
+                                  for hit in page]}}
+
+    def clear_scroll(self, scroll_id=None, body=None, **kwargs):
+        ids = [scroll_id] if scroll_id else body['scroll_id']
+        for scroll_id in ids:
+            _scrolls.pop(scroll_id, None)
+        return {'succeeded': True}
+
+
+def match_query(query, source):
+    """ Score of `source` for a query, None when it does not match """
+    (kind, params), = query.items()
+    if kind == 'match_all':
+        return 1.0
+    if kind == 'match':
+        (field, text), = params.items()
+        if isinstance(text, dict):
+            text = text['query']
+        words = set(tokenize(source.get(field, '')))
+        matched = [token for token in tokenize(text) if token in words]
+        return float(len(matched)) if matched else None
+    if kind == 'term':
+        (field, value), = params.items()
+        if isinstance(value, dict):
+            value = value['value']
+        return 1.0 if value in as_list(source.get(field)) else None
+    if kind == 'terms':
+        (field, values), = params.items()
+        found = set(as_list(source.get(field)))
+        return 1.0 if found.intersection(values) else None
+    if kind == 'range':
+        (field, bounds), = params.items()
+        value = range_value(source.get(field))
+        if value is None:
+            return None
+        checks = {'gt': value.__gt__, 'gte': value.__ge__,
+                  'lt': value.__lt__, 'lte': value.__le__}
+        ok = all(checks[op](range_value(bound))
+                 for op, bound in bounds.items() if op in checks)
+        return 1.0 if ok else None
+    if kind == 'bool':
+        score = 0.0
+        for clause in as_list(params.get('must')):
+            clause_score = match_query(clause, source)
+            if clause_score is None:
+                return None
+            score += clause_score
+        for clause in as_list(params.get('filter')):
+            if match_query(clause, source) is None:
+                return None
+        return score or 1.0
+    raise RequestError(400, 'parsing_exception', {'query': kind})
+
+
+def range_value(value):
+    """ Datetime strings as instants, so their UTC offsets are honoured """
+    if isinstance(value, str):
+        parsed = parse_datetime(value)
+        if parsed is not None:
+            return parsed if parsed.tzinfo else parsed.replace(tzinfo=utc)
+    return value
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def sort_key(hit, sort, raw=False):
+    """ Comparable key, descending fields are negated like ES sort values
+
+        Missing values sort last in either order, as they do in ES, and are
+        never compared with the values that are present.
+    """
+    key = []
+    for position, (field, order) in enumerate(sort_fields(sort)):
+        if raw:
+            value = hit['_sort'][position]
+        elif field == '_score':
+            value = hit['_score']
+        else:
+            value = hit['_source'].get(field)
+        missing = value is None
+        if order == 'desc':
+            value = Descending(value)
+        key.append((missing, value))
+    return tuple(key)
+
+
+def sort_fields(sort):
+    fields = []
+    for entry in as_list(sort) or ['_score']:
+        if entry == '_doc':
+            # Index order, which is what sorted() keeps for equal keys
+            continue
+        if isinstance(entry, str):
+            fields.append((entry, 'desc' if entry == '_score' else 'asc'))
+        else:
+            (field, order), = entry.items()
+            if isinstance(order, dict):
+                order = order.get('order', 'asc')
+            fields.append((field, order))
+    return fields
+
+
+def sort_hits(hits, sort):
+    hits = sorted(hits, key=lambda hit: sort_key(hit, sort))
+    for hit in hits:
+        hit['sort'] = [hit['_score'] if field == '_score'
+                       else hit['_source'].get(field)
+                       for field, _ in sort_fields(sort)]
+    return hits
+
+
+def filter_source(hit, source_fields):
+    hit = dict(hit)
+    if isinstance(source_fields, list):
+        hit['_source'] = {field: hit['_source'].get(field)
+                          for field in source_fields
+                          if field in hit['_source']}
+    return hit
+
+
+class Descending(object):
+    """ Reverses the ordering of a wrapped value """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __gt__(self, other):
+        return self.value < other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
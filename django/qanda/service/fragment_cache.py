@@ -0,0 +1,57 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from qanda.service import metrics
+
+# Every cached object or fragment is keyed on the current version of the
+# data it was built from, e.g. 'question:12' or 'answers:12'. Writes bump
+# those versions instead of deleting keys, old entries then expire unread.
+VERSION_KEY = 'qanda:version:{}'
+OBJECT_KEY = 'qanda:object:{}:{}'
+
+
+def get_versions(*names):
+    """ Current version of each name, as a list in the same order """
+    keys = [VERSION_KEY.format(name) for name in names]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # Seeded from the clock so a version evicted from the cache
+            # never comes back at a value older entries were stored under
+            cache.add(key, int(time.time() * 1000), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump(*names):
+    for name in names:
+        key = VERSION_KEY.format(name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, int(time.time() * 1000), timeout=None)
+
+
+def bump_on_commit(*names):
+    """ Bump once the write is visible, so it cannot be re-cached stale """
+    transaction.on_commit(lambda: bump(*names))
+
+
+def make_key(prefix, names, *args):
+    """ Key for `prefix` and `args` at the current version of `names` """
+    parts = ':'.join(str(part) for part in list(args) + get_versions(*names))
+    return OBJECT_KEY.format(prefix, hashlib.sha1(parts.encode()).hexdigest())
+
+
+def get_or_set(prefix, names, default, *args, timeout=None):
+    """ Cached `default()`, shared by every user until `names` are bumped """
+    key = make_key(prefix, names, *args)
+    value = cache.get(key)
+    metrics.record_cache(prefix, value is not None)
+    if value is None:
+        value = default()
+        cache.set(key, value, timeout or settings.CACHE_TTL)
+    return value
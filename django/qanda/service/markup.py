@@ -0,0 +1,17 @@
+from django.utils.html import linebreaks
+from django_markup.markup import formatter
+from qanda.service import metrics
+
+# Bump whenever the rendering below changes, stored HTML rendered by an older
+# version is then re-rendered the next time it is displayed.
+RENDERER_VERSION = 1
+
+
+def render_markdown(text):
+    """ Sanitized HTML for a post body, as the templates used to render it
+
+        safe_mode has django_markup clean the markdown output with bleach.
+    """
+    with metrics.timed(metrics.MARKDOWN_SECONDS):
+        html = formatter(text, filter_name='markdown', safe_mode=True)
+        return linebreaks(html)
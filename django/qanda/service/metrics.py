@@ -0,0 +1,344 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+# Metrics are observed in the memory of each process, which adds them to the
+# totals in a Redis hash at the end of a request, at most once every
+# METRICS_FLUSH_INTERVAL seconds. The web workers of a host share one scrape
+# target, so /metrics renders those totals and not the registry of whichever
+# worker happens to serve the scrape.
+METRICS_KEY = 'qanda:metrics:requests'
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+logger = logging.getLogger(__name__)
+
+_registry = {}
+_lock = threading.Lock()
+# Totals of the request being served by this thread, see RequestMetrics
+_request = threading.local()
+# time.monotonic() of the last flush started by maybe_flush
+_last_flush = None
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+def number(raw):
+    value = float(raw)
+    return int(value) if value.is_integer() else value
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def label_values(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def field(self, label_values, part=''):
+        """ Field of the METRICS_KEY hash holding one of the values """
+        return json.dumps([self.name, list(label_values), part])
+
+    def take(self):
+        """ The values observed since the last take, cleared """
+        with _lock:
+            values, self.values = self.values, {}
+        return values
+
+    def restore(self, values):
+        """ Put back taken values that could not be stored """
+        with _lock:
+            for label_values, value in values.items():
+                self.merge(label_values, value)
+
+    def format_labels(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(f'{name}="{escape(value)}"'
+                                 for name, value in pairs)
+
+    def render(self, values=None):
+        """ Text of `values`, the ones observed here when None """
+        lines = [f'# HELP {self.name} {self.help_text}',
+                 f'# TYPE {self.name} {self.kind}']
+        with _lock:
+            values = sorted((self.values if values is None
+                             else values).items())
+        for label_values, value in values:
+            lines.extend(self.render_value(label_values, value))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render_value(self, label_values, value):
+        return [f'{self.name}{self.format_labels(label_values)} {value}']
+
+    def merge(self, label_values, value):
+        self.values[label_values] = self.values.get(label_values, 0) + value
+
+    def increments(self, label_values, value):
+        return [(self.field(label_values), value)]
+
+    def load(self, parts):
+        return parts['']
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[self.label_values(labels)] = value
+
+    def merge(self, label_values, value):
+        # A value set since the failed flush is the newer one
+        self.values.setdefault(label_values, value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        with _lock:
+            counts, total = self.values.get(
+                key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def render_value(self, label_values, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            labels = self.format_labels(label_values, [('le', bound)])
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = self.format_labels(label_values)
+        lines.append(f'{self.name}_sum{labels} {total}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+    def merge(self, label_values, value):
+        counts, total = self.values.get(
+            label_values, ([0] * (len(self.buckets) + 1), 0))
+        self.values[label_values] = (
+            [mine + other for mine, other in zip(counts, value[0])],
+            total + value[1])
+
+    def increments(self, label_values, value):
+        counts, total = value
+        return [(self.field(label_values, bucket), count)
+                for bucket, count in enumerate(counts) if count] + \
+            [(self.field(label_values, 'sum'), total)]
+
+    def load(self, parts):
+        counts = [parts.get(bucket, 0)
+                  for bucket in range(len(self.buckets) + 1)]
+        return counts, parts.get('sum', 0)
+
+
+def register(metric):
+    """ Add `metric` to the registry, or return the one of the same name """
+    with _lock:
+        return _registry.setdefault(metric.name, metric)
+
+
+def flush():
+    """ Add the values observed by this process to the shared totals """
+    with _lock:
+        metrics = list(_registry.values())
+    taken = [(metric, metric.take()) for metric in metrics]
+    pipe = get_redis_connection('default').pipeline()
+    for metric, values in taken:
+        for label_values, value in values.items():
+            if metric.kind == 'gauge':
+                pipe.hset(METRICS_KEY, metric.field(label_values), value)
+                continue
+            for field, amount in metric.increments(label_values, value):
+                if isinstance(amount, int):
+                    pipe.hincrby(METRICS_KEY, field, amount)
+                else:
+                    pipe.hincrbyfloat(METRICS_KEY, field, amount)
+    try:
+        pipe.execute()
+    except Exception:
+        # Kept for the next flush, a Redis outage must not fail requests
+        logger.warning('Could not flush the metrics', exc_info=True)
+        for metric, values in taken:
+            metric.restore(values)
+
+
+def maybe_flush():
+    """ flush() unless this process did within METRICS_FLUSH_INTERVAL
+
+        Returns whether it flushed, the values observed meanwhile wait in
+        memory for the next one.
+    """
+    global _last_flush
+    now = time.monotonic()
+    with _lock:
+        if _last_flush is not None and \
+                now - _last_flush < settings.METRICS_FLUSH_INTERVAL:
+            return False
+        _last_flush = now
+    flush()
+    return True
+
+
+def stored_values():
+    """ {name: {label values: value}} of the shared totals """
+    stored = defaultdict(lambda: defaultdict(dict))
+    for field, raw in get_redis_connection('default') \
+            .hgetall(METRICS_KEY).items():
+        name, label_values, part = json.loads(field)
+        stored[name][tuple(label_values)][part] = number(raw)
+    return stored
+
+
+def render():
+    """ Prometheus text of the totals of every process """
+    flush()
+    with _lock:
+        metrics = sorted(_registry.values(), key=lambda m: m.name)
+    stored = stored_values()
+    return '\n'.join(
+        line for metric in metrics
+        for line in metric.render({
+            label_values: metric.load(parts)
+            for label_values, parts in stored[metric.name].items()})
+    ) + '\n'
+
+
+REQUEST_SECONDS = register(Histogram(
+    'qanda_request_duration_seconds', 'Time to serve a request',
+    ['view', 'method', 'status']))
+REQUEST_DB_QUERIES = register(Histogram(
+    'qanda_request_db_queries', 'SQL queries run by a request', ['view'],
+    COUNT_BUCKETS))
+REQUEST_DB_SECONDS = register(Histogram(
+    'qanda_request_db_seconds', 'Time a request spent in SQL', ['view']))
+REQUEST_ES_SECONDS = register(Histogram(
+    'qanda_request_es_seconds', 'Time a request spent in Elasticsearch',
+    ['view']))
+REQUEST_TEMPLATE_SECONDS = register(Histogram(
+    'qanda_request_template_seconds', 'Time a request spent rendering',
+    ['view']))
+CACHE_REQUESTS = register(Counter(
+    'qanda_cache_requests_total', 'Cache lookups by view and outcome',
+    ['view', 'cache', 'result']))
+ES_SECONDS = register(Histogram(
+    'qanda_es_call_duration_seconds', 'Elasticsearch calls',
+    ['operation']))
+TEMPLATE_SECONDS = register(Histogram(
+    'qanda_template_render_seconds', 'Rendering of a view template',
+    ['template']))
+MARKDOWN_SECONDS = register(Histogram(
+    'qanda_markdown_render_seconds', 'Markdown rendering of a post body'))
+
+
+class RequestMetrics(object):
+    """ Totals of one request, filled by the hooks while it is served """
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.es_seconds = 0.0
+        self.template_seconds = 0.0
+        self.cache = defaultdict(int)
+
+
+def start_request():
+    _request.current = RequestMetrics()
+    return _request.current
+
+
+def end_request(view, method, status, elapsed):
+    """ Observe the totals of the request served by this thread """
+    request = current_request()
+    _request.current = None
+    REQUEST_SECONDS.observe(elapsed, view=view, method=method, status=status)
+    if request is None:
+        return
+    REQUEST_DB_QUERIES.observe(request.db_queries, view=view)
+    REQUEST_DB_SECONDS.observe(request.db_seconds, view=view)
+    REQUEST_ES_SECONDS.observe(request.es_seconds, view=view)
+    REQUEST_TEMPLATE_SECONDS.observe(request.template_seconds, view=view)
+    for (cache_name, result), count in request.cache.items():
+        CACHE_REQUESTS.inc(count, view=view, cache=cache_name, result=result)
+
+
+def current_request():
+    return getattr(_request, 'current', None)
+
+
+def record_db(execute, sql, params, many, context):
+    """ connection.execute_wrapper hook counting the request's queries """
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        request = current_request()
+        if request is not None:
+            request.db_queries += 1
+            request.db_seconds += time.perf_counter() - started
+
+
+def record_cache(cache_name, hit):
+    request = current_request()
+    if request is not None:
+        request.cache[(cache_name, 'hit' if hit else 'miss')] += 1
+
+
+@contextmanager
+def timed(histogram, request_field=None, **labels):
+    """ Observe the time spent in the block, also adding it to the request """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.observe(elapsed, **labels)
+        request = current_request()
+        if request_field and request is not None:
+            setattr(request, request_field,
+                    getattr(request, request_field) + elapsed)
+
+
+def timed_es(operation):
+    """ Decorator timing a call into Elasticsearch """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(ES_SECONDS, 'es_seconds', operation=operation):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
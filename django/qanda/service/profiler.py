@@ -0,0 +1,88 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Profiles are written in the folded stacks format, one "root;...;leaf n"
+# line per distinct stack, which flamegraph.pl and speedscope read as is.
+PROFILE_SUFFIX = '.folded'
+# Separates the url name from the unique part of a profile file name
+NAME_SEPARATOR = '__'
+
+
+class SamplingProfiler(object):
+    """ Samples the stack of one thread from a background thread
+
+        Nothing is traced, the profiled thread only pays for the sampler
+        holding the GIL while it copies the stack every `interval` seconds.
+    """
+
+    def __init__(self, thread_id=None, interval=0.005):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True,
+                                        name='qanda-profiler')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.stacks
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[fold(frame)] += 1
+
+
+def fold(frame):
+    """ The stack of `frame` as 'root;...;leaf' """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        names.append(f'{code.co_name} ({filename}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def profile_path(directory, url_name):
+    name = url_name.replace(':', '.').replace(os.sep, '_')
+    unique = f'{time.time():.6f}-{os.getpid()}-{threading.get_ident()}'
+    return os.path.join(directory,
+                        f'{name}{NAME_SEPARATOR}{unique}{PROFILE_SUFFIX}')
+
+
+def write_profile(directory, url_name, stacks):
+    """ Write `stacks` for a request to `url_name`, return the path """
+    os.makedirs(directory, exist_ok=True)
+    path = profile_path(directory, url_name)
+    partial = path + '.tmp'
+    with open(partial, 'w') as profile:
+        profile.writelines(f'{stack} {count}\n'
+                           for stack, count in stacks.items())
+    # Renamed once complete so the merge never reads half a profile
+    os.replace(partial, path)
+    return path
+
+
+def read_profile(path):
+    stacks = Counter()
+    with open(path) as profile:
+        for line in profile:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack:
+                stacks[stack] += int(count)
+    return stacks
+
+
+def url_name_of(path):
+    return os.path.basename(path).split(NAME_SEPARATOR)[0]
@@ -0,0 +1,42 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from qanda.service import fragment_cache, metrics
+
+# Bumped by every index write, which orphans all the cached results at once
+GENERATION_NAME = 'search-index'
+RESULTS_KEY = 'qanda:search:{}:{}'
+
+
+def get_generation():
+    return fragment_cache.get_versions(GENERATION_NAME)[0]
+
+
+def bump_generation():
+    fragment_cache.bump(GENERATION_NAME)
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+
+def make_key(query, **params):
+    """ Cache key for a search and its filters, shared across users """
+    params['q'] = normalize_query(query)
+    # default=str serializes the date filters
+    digest = hashlib.sha1(json.dumps(
+        params, sort_keys=True, default=str).encode()).hexdigest()
+    return RESULTS_KEY.format(get_generation(), digest)
+
+
+def get_or_search(search, query, **params):
+    """ Cached `search(query, **params)` for the current index generation """
+    key = make_key(query, **params)
+    results = cache.get(key)
+    metrics.record_cache('search', results is not None)
+    if results is None:
+        results = search(normalize_query(query), **params)
+        cache.set(key, results, settings.SEARCH_CACHE_TTL)
+    return results
@@ -0,0 +1,135 @@
+import logging
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+# Sorted set of dirty question ids scored by when they first became dirty.
+# Being a set, repeated writes to the same question coalesce into one entry.
+OUTBOX_KEY = 'qanda:search:outbox'
+# While a reindex loads a new index the outbox keeps writing to the old one
+# through the alias, the ids it pushes are recorded to be replayed after
+# the alias swap.
+REINDEX_FLAG_KEY = 'qanda:search:reindexing'
+REINDEX_IDS_KEY = 'qanda:search:reindex-ids'
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(question_id):
+    """ Mark a question as needing to be (re)indexed or removed """
+    redis = get_redis_connection('default')
+    # nx keeps the oldest timestamp so the lag reflects the real wait
+    redis.zadd(OUTBOX_KEY, {question_id: time.time()}, nx=True)
+
+
+def enqueue_many(question_ids):
+    """ Mark several questions at once, see enqueue """
+    if question_ids:
+        now = time.time()
+        get_redis_connection('default').zadd(
+            OUTBOX_KEY, {question_id: now for question_id in question_ids},
+            nx=True)
+
+
+def pop_batch(size):
+    """ Atomically take the `size` oldest entries as {id: dirty_since} """
+    pipe = get_redis_connection('default').pipeline()
+    pipe.zrange(OUTBOX_KEY, 0, size - 1, withscores=True)
+    pipe.zremrangebyrank(OUTBOX_KEY, 0, size - 1)
+    entries, _ = pipe.execute()
+    return {int(question_id): dirty_since
+            for question_id, dirty_since in entries}
+
+
+def requeue(entries):
+    """ Put back entries that failed to index, keeping their timestamps """
+    if entries:
+        get_redis_connection('default').zadd(OUTBOX_KEY, entries, nx=True)
+
+
+def start_capture():
+    """ Record the ids pushed from now on, until end_capture
+
+        The ids left over from a reindex that never finished are dropped.
+        The record expires unless refresh_capture is called within
+        SEARCH_REINDEX_CAPTURE_TTL.
+    """
+    pipe = get_redis_connection('default').pipeline()
+    pipe.delete(REINDEX_IDS_KEY)
+    pipe.set(REINDEX_FLAG_KEY, 1, ex=settings.SEARCH_REINDEX_CAPTURE_TTL)
+    pipe.execute()
+
+
+def refresh_capture():
+    """ Extend the capture of a running reindex, False if it expired """
+    pipe = get_redis_connection('default').pipeline()
+    pipe.expire(REINDEX_FLAG_KEY, settings.SEARCH_REINDEX_CAPTURE_TTL)
+    pipe.expire(REINDEX_IDS_KEY, settings.SEARCH_REINDEX_CAPTURE_TTL)
+    capturing, _ = pipe.execute()
+    return bool(capturing)
+
+
+def capture(question_ids):
+    redis = get_redis_connection('default')
+    if question_ids and redis.exists(REINDEX_FLAG_KEY):
+        pipe = redis.pipeline()
+        pipe.sadd(REINDEX_IDS_KEY, *question_ids)
+        pipe.expire(REINDEX_IDS_KEY, settings.SEARCH_REINDEX_CAPTURE_TTL)
+        pipe.execute()
+
+
+def end_capture():
+    """ Stop recording, return the ids pushed since start_capture """
+    pipe = get_redis_connection('default').pipeline()
+    pipe.delete(REINDEX_FLAG_KEY)
+    pipe.smembers(REINDEX_IDS_KEY)
+    pipe.delete(REINDEX_IDS_KEY)
+    _, question_ids, _ = pipe.execute()
+    return {int(question_id) for question_id in question_ids}
+
+
+def stats():
+    """ Outbox size and age in seconds of its oldest entry (index lag) """
+    redis = get_redis_connection('default')
+    pipe = redis.pipeline()
+    pipe.zcard(OUTBOX_KEY)
+    pipe.zrange(OUTBOX_KEY, 0, 0, withscores=True)
+    pending, oldest = pipe.execute()
+    lag = time.time() - oldest[0][1] if oldest else 0.0
+    return {'pending': pending, 'lag_seconds': lag}
+
+
+def drain():
+    """ Push the dirty questions to Elasticsearch in bulk batches
+
+        Returns the number of questions processed in this run.
+    """
+    from qanda.models import Question
+    from qanda.service import elasticsearch
+
+    processed = 0
+    for _ in range(settings.SEARCH_OUTBOX_MAX_BATCHES):
+        entries = pop_batch(settings.SEARCH_OUTBOX_BATCH_SIZE)
+        if not entries:
+            break
+        capture(list(entries))
+        questions = list(Question.objects.filter(pk__in=entries))
+        deleted_ids = set(entries) - {q.id for q in questions}
+        try:
+            failed_ids = elasticsearch.bulk_sync(questions, deleted_ids)
+        except Exception:
+            requeue(entries)
+            raise
+        processed += len(entries) - len(failed_ids)
+        if failed_ids:
+            # Leave the retry for the next run instead of spinning on it
+            requeue({question_id: entries[question_id]
+                     for question_id in failed_ids})
+            break
+
+    outbox_stats = stats()
+    logger.info('Search outbox drained %d, %d pending, lag %.1fs',
+                processed, outbox_stats['pending'],
+                outbox_stats['lag_seconds'])
+    return processed
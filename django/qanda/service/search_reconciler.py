@@ -0,0 +1,60 @@
+import logging
+
+from django.conf import settings
+from django.db.models import Max
+from django.utils.dateparse import parse_datetime
+from qanda.service import search_outbox
+
+logger = logging.getLogger(__name__)
+
+
+def find_drift(indexed, stored):
+    """ Ids whose document is missing, stale or orphaned
+
+        Both arguments map question id -> (modified, score), `indexed` as
+        read back from Elasticsearch (modified as an ISO string) and
+        `stored` from the database. The score is compared on its own as
+        votes change it without touching modified.
+    """
+    drifted = set(indexed) ^ set(stored)
+    for question_id, (modified, score) in stored.items():
+        if question_id not in indexed:
+            continue
+        indexed_modified, indexed_score = indexed[question_id]
+        if parse_datetime(indexed_modified or '') != modified or \
+                indexed_score != score:
+            drifted.add(question_id)
+    return drifted
+
+
+def reconcile(chunk_size=None):
+    """ Queue every question whose document differs from its row
+
+        Ids are compared one range at a time on both sides so memory stays
+        bounded. The outbox then re-indexes the rows that exist and deletes
+        the documents of those that do not. Returns the number queued.
+    """
+    from qanda.models import Question
+    from qanda.service import elasticsearch
+
+    chunk_size = chunk_size or settings.SEARCH_RECONCILE_CHUNK_SIZE
+    last_id = Question.objects.aggregate(last=Max('pk'))['last'] or 0
+    queued = 0
+    for start_id in range(0, last_id + 1, chunk_size):
+        end_id = start_id + chunk_size
+        # The last range is open ended to catch documents of deleted rows
+        # above the current last id
+        if end_id > last_id:
+            end_id = None
+        indexed = dict(elasticsearch.scan_indexed(start_id, end_id))
+        rows = Question.objects.filter(pk__gte=start_id)
+        if end_id is not None:
+            rows = rows.filter(pk__lt=end_id)
+        stored = {pk: (modified, score) for pk, modified, score
+                  in rows.values_list('pk', 'modified', 'score')}
+        drifted = find_drift(indexed, stored)
+        search_outbox.enqueue_many(drifted)
+        queued += len(drifted)
+
+    logger.info('Search reconciler queued %d drifted questions', queued)
+    return queued
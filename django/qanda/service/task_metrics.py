@@ -0,0 +1,92 @@
+import logging
+import time
+from bisect import bisect_left
+
+from celery import current_app
+from celery.signals import task_postrun, task_prerun
+from django.conf import settings
+from django_redis import get_redis_connection
+from qanda.service import metrics, search_outbox
+
+# Tasks run in the worker processes, so their durations are summed into a
+# Redis hash that the /metrics view of any web process can read back.
+TASK_DURATIONS_KEY = 'qanda:metrics:tasks'
+
+logger = logging.getLogger(__name__)
+
+_started = {}
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    _started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def record_task_duration(task_id=None, task=None, state=None, **kwargs):
+    started = _started.pop(task_id, None)
+    if started is None or not task.name.startswith('qanda.'):
+        return
+    elapsed = time.perf_counter() - started
+    field = f'{task.name}|{state}'
+    bucket = bisect_left(metrics.DEFAULT_BUCKETS, elapsed)
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    pipe.hincrby(TASK_DURATIONS_KEY, f'{field}|bucket|{bucket}', 1)
+    pipe.hincrbyfloat(TASK_DURATIONS_KEY, f'{field}|sum', elapsed)
+    pipe.execute()
+
+
+def task_durations():
+    histogram = metrics.Histogram(
+        'qanda_task_duration_seconds', 'Celery task run time',
+        ['task', 'state'])
+    stored = get_redis_connection('default').hgetall(TASK_DURATIONS_KEY)
+    for field, value in stored.items():
+        task, state, kind, *bucket = field.decode().split('|')
+        counts, total = histogram.values.get(
+            (task, state), ([0] * (len(histogram.buckets) + 1), 0))
+        if kind == 'sum':
+            total = float(value)
+        else:
+            counts[int(bucket[0])] = int(value)
+        histogram.values[(task, state)] = (counts, total)
+    return [histogram]
+
+
+def queue_depths():
+    gauge = metrics.Gauge('qanda_celery_queue_depth',
+                          'Messages waiting in a Celery queue', ['queue'])
+    with current_app.connection_for_read() as connection:
+        # Fail fast instead of retrying while the scrape waits
+        connection.ensure_connection(max_retries=1)
+        channel = connection.default_channel
+        for queue in settings.METRICS_CELERY_QUEUES:
+            declared = channel.queue_declare(queue=queue, passive=True)
+            gauge.set(declared.message_count, queue=queue)
+    return [gauge]
+
+
+def search_outbox_gauges():
+    stats = search_outbox.stats()
+    pending = metrics.Gauge('qanda_search_outbox_pending',
+                            'Questions waiting to be indexed')
+    pending.set(stats['pending'])
+    lag = metrics.Gauge('qanda_search_outbox_lag_seconds',
+                        'Age of the oldest question waiting to be indexed')
+    lag.set(stats['lag_seconds'])
+    return [pending, lag]
+
+
+def render():
+    """ Prometheus text for the task, queue and indexing backlog metrics """
+    lines = []
+    for collect in (task_durations, queue_depths, search_outbox_gauges):
+        try:
+            collected = collect()
+        except Exception:
+            # A broker or Redis outage must not take the web metrics down
+            logger.exception('Could not collect %s', collect.__name__)
+            continue
+        for metric in collected:
+            lines.extend(metric.render())
+    return '\n'.join(lines) + '\n' if lines else ''
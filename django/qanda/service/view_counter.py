@@ -0,0 +1,65 @@
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django_redis import get_redis_connection
+from qanda.service import fragment_cache
+from redis.exceptions import ResponseError
+
+PENDING_VIEWS_KEY = 'qanda:views:pending'
+SEEN_VIEW_KEY = 'qanda:views:seen:{}:{}'
+
+
+def record_view(question_id, visitor):
+    """ Buffer a question view in Redis, once per visitor per window """
+    redis = get_redis_connection('default')
+    first_view = redis.set(SEEN_VIEW_KEY.format(question_id, visitor), 1,
+                           nx=True, ex=settings.VIEW_COUNT_WINDOW)
+    if first_view:
+        redis.hincrby(PENDING_VIEWS_KEY, question_id, 1)
+    return bool(first_view)
+
+
+def flush_views():
+    """ Move the buffered views into Question.viewed
+
+        Questions are grouped by their pending count so each group is a
+        single `UPDATE ... SET viewed = viewed + n`. Going through update()
+        leaves `modified` and the search index untouched.
+    """
+    from qanda.models import Question
+
+    redis = get_redis_connection('default')
+    # Renaming detaches the hash so views recorded meanwhile are not lost
+    flushing_key = f'{PENDING_VIEWS_KEY}:{uuid.uuid4().hex}'
+    try:
+        redis.rename(PENDING_VIEWS_KEY, flushing_key)
+    except ResponseError:
+        # Nothing was viewed since the last flush
+        return 0
+
+    pending = {int(question_id): int(count) for question_id, count
+               in redis.hgetall(flushing_key).items()}
+    by_count = defaultdict(list)
+    for question_id, count in pending.items():
+        by_count[count].append(question_id)
+
+    try:
+        with transaction.atomic():
+            for count, question_ids in by_count.items():
+                Question.objects.filter(pk__in=question_ids) \
+                    .update(viewed=F('viewed') + count)
+    except Exception:
+        # Put the views back so the next flush retries them
+        pipe = redis.pipeline()
+        for question_id, count in pending.items():
+            pipe.hincrby(PENDING_VIEWS_KEY, question_id, count)
+        pipe.delete(flushing_key)
+        pipe.execute()
+        raise
+
+    redis.delete(flushing_key)
+    fragment_cache.bump(*[f'question:{pk}' for pk in pending])
+    return sum(pending.values())
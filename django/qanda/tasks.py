@@ -1,12 +1,49 @@
 from celery import shared_task
+from django.conf import settings
+from django.core.mail import get_connection
+# Imported for its signal receivers, which time every task
+from qanda.service import task_metrics  # noqa: F401
 
 
 @shared_task
 def build_new_answer_email(question_id):
+    """ Email immediate subscribers in chunks, queue the digest ones """
     # Import at function level to avoid circular dependency error
     from qanda.models import QuestionSubscription
-    subscribers = QuestionSubscription.objects.filter(question_id=question_id)
-    return [sub.email_new_answer() for sub in subscribers]
+    from qanda.service import answer_digest
+    subscriptions = QuestionSubscription.objects \
+        .filter(question_id=question_id).order_by('pk') \
+        .values_list('pk', 'user_id', 'delivery').iterator()
+    chunk = []
+    digest_subscribers = []
+    for subscription_id, user_id, delivery in subscriptions:
+        if delivery != QuestionSubscription.IMMEDIATE:
+            digest_subscribers.append((user_id, delivery))
+            continue
+        chunk.append(subscription_id)
+        if len(chunk) == settings.NEW_ANSWER_EMAIL_CHUNK_SIZE:
+            send_new_answer_emails.delay(question_id, chunk[0], chunk[-1])
+            chunk = []
+    if chunk:
+        send_new_answer_emails.delay(question_id, chunk[0], chunk[-1])
+    if digest_subscribers:
+        answer_digest.add_new_answer(question_id, digest_subscribers)
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def send_new_answer_emails(self, question_id, first_id, last_id):
+    """ Email a chunk of subscribers over a single backend connection """
+    from qanda.models import Question, QuestionSubscription
+    question = Question.objects.get(pk=question_id)
+    subscriptions = QuestionSubscription.objects.filter(
+        question_id=question_id, pk__range=(first_id, last_id),
+        delivery=QuestionSubscription.IMMEDIATE).select_related('user')
+    messages = QuestionSubscription.new_answer_emails(question, subscriptions)
+    try:
+        with get_connection() as connection:
+            return connection.send_messages(messages)
+    except Exception as exc:
+        raise self.retry(exc=exc)
 
 
 @shared_task
@@ -14,3 +51,37 @@ def send_email(user_id, subject, message):
     from django.contrib.auth import get_user_model as User
     user = User().objects.get(id=user_id)
     user.email_user(subject, message)
+
+
+@shared_task
+def send_answer_digests(delivery):
+    from qanda.service import answer_digest
+    return answer_digest.send_digests(delivery)
+
+
+@shared_task
+def flush_question_views():
+    from qanda.service import view_counter
+    return view_counter.flush_views()
+
+
+@shared_task
+def drain_search_outbox():
+    from qanda.service import search_outbox
+    return search_outbox.drain()
+
+
+@shared_task
+def rebuild_reputation(chunk_size=5000):
+    from django.db.models import Max
+    from qanda.models import Profile
+    last_id = Profile.objects.aggregate(last=Max('pk'))['last'] or 0
+    return sum(Profile.objects.reconcile_reputation(start_id,
+                                                    start_id + chunk_size)
+               for start_id in range(0, last_id + 1, chunk_size))
+
+
+@shared_task
+def reconcile_search_index():
+    from qanda.service import search_reconciler
+    return search_reconciler.reconcile()
@@ -1,3 +1,912 @@
-from django.test import TestCase
+import json
+import os
+import re
+import tempfile
+from collections import Counter
+from datetime import date, datetime, timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model as User
+from django.core import mail
+from django.core.cache import cache, caches
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import F, OuterRef, Sum
+from django.test import (RequestFactory, SimpleTestCase, TestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+from django_redis import get_redis_connection
+from qanda.middleware import ProfilingMiddleware
+from qanda.models import (Answer, AnswerVote, Profile, Question,
+                          QuestionSubscription, QuestionVote, Tag,
+                          _subquery_total)
+from qanda.service import (answer_digest, elasticsearch, fake_elasticsearch,
+                           metrics, search_outbox, search_reconciler,
+                           view_counter)
+from qanda.tokens import account_activation_token
+
+
+@skipUnless(connection.vendor == 'postgresql', 'EXPLAIN plans are Postgres')
+class QueryPlanTests(TestCase):
+    """ Every hot query must be answerable from an index
+
+        Sequential scans are disabled for the session, so the planner only
+        falls back to one when no index can serve the query.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        users = [User().objects.create(username=f'user{i}') for i in range(5)]
+        Question.objects.bulk_create(
+            Question(user=users[i % 5], title=f'Question {i}', body='body',
+                     created=now, modified=now)
+            for i in range(50))
+        questions = list(Question.objects.all())
+        Answer.objects.bulk_create(
+            Answer(user=users[i % 5], question=questions[i % 50],
+                   body='body', created=now, modified=now)
+            for i in range(200))
+        answers = list(Answer.objects.all())
+        QuestionVote.objects.bulk_create(
+            QuestionVote(user=user, question=question, value=1)
+            for user in users for question in questions)
+        AnswerVote.objects.bulk_create(
+            AnswerVote(user=user, answer=answer, value=-1)
+            for user in users for answer in answers)
+        QuestionSubscription.objects.bulk_create(
+            QuestionSubscription(user=user, question=question)
+            for user in users for question in questions)
+        cls.user = users[0]
+        cls.question = questions[0]
+        cls.answer = answers[0]
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+
+    def assertNoSeqScan(self, queryset):
+        plan = queryset.explain()
+        self.assertNotIn('Seq Scan', plan, f'\n{queryset.query}\n{plan}')
+
+    def test_homepage_sorts(self):
+        for field in ('created', 'score', 'answers_score'):
+            with self.subTest(field=field):
+                self.assertNoSeqScan(
+                    Question.objects.all_with_prefetch_tags()
+                    .order_by(f'-{field}', '-pk')[:10])
+
+    def test_question_answers(self):
+        self.assertNoSeqScan(Answer.objects.all_with_score()
+                             .filter(question=self.question)
+                             .select_related('user'))
+
+    def test_last_answers(self):
+        self.assertNoSeqScan(Answer.objects.all()
+                             .select_related('question', 'user')
+                             .order_by('-created')[:5])
+
+    def test_user_posts(self):
+        self.assertNoSeqScan(Answer.objects.all_with_score()
+                             .filter(user=self.user)
+                             .select_related('question').order_by('-score'))
+        self.assertNoSeqScan(Question.objects.all_with_relations_and_score()
+                             .filter(user=self.user).order_by('-score'))
+
+    def test_user_votes(self):
+        self.assertNoSeqScan(QuestionVote.objects.filter(
+            user=self.user, question=self.question))
+        self.assertNoSeqScan(AnswerVote.objects.filter(
+            user=self.user, answer__in=[self.answer]))
+
+    def test_score_subqueries(self):
+        self.assertNoSeqScan(Question.objects.filter(pk__lt=10).annotate(
+            total=_subquery_total(
+                QuestionVote.objects.filter(question=OuterRef('pk')),
+                'question', Sum('value'))))
+        self.assertNoSeqScan(Answer.objects.filter(pk__lt=10).annotate(
+            total=_subquery_total(
+                AnswerVote.objects.filter(answer=OuterRef('pk')),
+                'answer', Sum('value'))))
+
+    def test_top_users(self):
+        self.assertNoSeqScan(Profile.objects.top_by_reputation(5))
+
+    def test_question_subscribers(self):
+        self.assertNoSeqScan(QuestionSubscription.objects
+                             .filter(question=self.question).order_by('pk')
+                             .values_list('pk', 'user_id', 'delivery'))
+
+
+# The services keep their buffers and queues in Redis under fixed keys, the
+# tests using them get a database of their own and flush it before each one.
+REDIS_TEST_DB = 15
+REDIS_TEST_CACHES = {'default': dict(
+    settings.CACHES['default'], KEY_PREFIX='qanda-tests',
+    LOCATION=re.sub(r'/\d+$', f'/{REDIS_TEST_DB}',
+                    settings.CACHES['default'].get('LOCATION', '')))}
+
+
+class CaptureCacheCalls(object):
+    """ Records the calls made to the default cache while active
+
+        The pushes to the search outbox, which lives in the same Redis, are
+        recorded too.
+    """
+    METHODS = ('get', 'get_many', 'get_or_set', 'set', 'set_many', 'add',
+               'incr', 'delete', 'delete_many')
+    OUTBOX_FUNCTIONS = ('enqueue', 'enqueue_many')
+
+    def __enter__(self):
+        self.backend = caches['default']
+        self.calls = []
+        for name in self.METHODS:
+            setattr(self.backend, name,
+                    self.recorded(name, getattr(self.backend, name)))
+        self.outbox_functions = {name: getattr(search_outbox, name)
+                                 for name in self.OUTBOX_FUNCTIONS}
+        for name, function in self.outbox_functions.items():
+            setattr(search_outbox, name, self.recorded(name, function))
+        return self
+
+    def __exit__(self, *exc_info):
+        for name in self.METHODS:
+            delattr(self.backend, name)
+        for name, function in self.outbox_functions.items():
+            setattr(search_outbox, name, function)
+
+    def __len__(self):
+        return len(self.calls)
+
+    def recorded(self, name, method):
+        def call(*args, **kwargs):
+            self.calls.append(f'{name} {args[0] if args else ""}')
+            return method(*args, **kwargs)
+        return call
+
+
+def query_shape(sql):
+    """ SQL with its literals blanked, repeated shapes point at an N+1 """
+    return re.sub(r"\b\d+\b|'[^']*'", '?', sql)
+
+
+def query_diff(executed, budget):
+    """ Numbered queries, the ones past `budget` and repeats marked """
+    repeated = Counter(query_shape(sql) for sql in executed)
+    lines = []
+    for position, sql in enumerate(executed):
+        marker = '+' if position >= budget else ' '
+        count = repeated[query_shape(sql)]
+        repeat = f'(x{count}) ' if count > 1 else ''
+        lines.append(f'{marker} {position + 1:>3}. {repeat}{sql}')
+    return '\n'.join(lines)
+
+
+class SerialPool(object):
+    """ Runs the reindex workers in the test's process and transaction """
+
+    def __init__(self, processes=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def imap_unordered(self, func, iterable):
+        return map(func, iterable)
+
+
+def run_on_commit(test):
+    """ Run on_commit callbacks at once, a TestCase never commits """
+    patcher = mock.patch('django.db.transaction.on_commit',
+                         lambda func, using=None: func())
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'budgets are for Postgres')
+@override_settings(ES_FAKE=True, CACHES=REDIS_TEST_CACHES)
+class ViewBudgetTests(TestCase):
+    """ Ceilings on the SQL queries and cache calls of every qanda view
+
+        Each request runs against an empty cache, the first visitor pays
+        for filling it. The on_commit callbacks run at once, so the cache
+        calls of a write include its version bumps and outbox pushes.
+        Lower a budget when a view gets cheaper, raising one needs a
+        reason.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        fake_elasticsearch.reset()
+        elasticsearch._client = None
+        call_command('seed_offbyone', users=6, questions=30, tags=10,
+                     answers=3, votes=4, subscriptions=2, seed=22,
+                     stdout=StringIO())
+        cls.question = Question.objects.filter(answer_count__gt=1) \
+            .order_by('pk').first()
+        cls.owner = cls.question.user
+        cls.answer = Answer.objects.filter(question=cls.question) \
+            .exclude(user=cls.owner).order_by('pk').first()
+        cls.visitor = User().objects.exclude(pk=cls.owner.pk) \
+            .exclude(questionvote__question=cls.question) \
+            .exclude(answervote__answer=cls.answer) \
+            .exclude(questionsubscription__question=cls.question) \
+            .order_by('pk').first()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        fake_elasticsearch.reset()
+        elasticsearch._client = None
+
+    def setUp(self):
+        get_redis_connection('default').flushdb()
+        run_on_commit(self)
+        # Keep the new answer emails off the broker
+        patcher = mock.patch('qanda.tasks.build_new_answer_email.delay')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertBudget(self, queries, cache_calls, url, method='get',
+                     data=None, user=None, **extra):
+        if user is not None:
+            self.client.force_login(user)
+        with CaptureQueriesContext(connection) as captured, \
+                CaptureCacheCalls() as cached:
+            response = getattr(self.client, method)(url, data or {},
+                                                    **extra)
+        self.assertLess(response.status_code, 400, url)
+
+        executed = [query['sql'] for query in captured.captured_queries]
+        if len(executed) > queries:
+            self.fail(f'{method.upper()} {url} ran {len(executed)} queries, '
+                      f'budget {queries}, + marks the overrun:\n'
+                      + query_diff(executed, queries))
+        if len(cached) > cache_calls:
+            self.fail(f'{method.upper()} {url} made {len(cached)} cache '
+                      f'calls, budget {cache_calls}:\n'
+                      + '\n'.join(cached.calls))
+        return response
+
+    def question_url(self, question=None):
+        question = question or self.question
+        return reverse('qanda:question_detail', kwargs={
+            'pk': question.pk, 'title': question.title_as_hyphen()})
+
+    def test_homepage(self):
+        for sort in ('top', 'newest', 'answered'):
+            with self.subTest(sort=sort):
+                cache.delete_pattern('*')
+                self.assertBudget(5, 19, reverse('qanda:home'),
+                                  data={'sort': sort})
+
+    def test_homepage_warm(self):
+        url = reverse('qanda:home')
+        self.client.get(url)
+        self.assertBudget(0, 8, url)
+
+    def test_question_detail_anonymous(self):
+        self.assertBudget(3, 10, self.question_url())
+
+    def test_question_detail_owner(self):
+        self.assertBudget(8, 10, self.question_url(),
+                          user=self.owner)
+
+    def test_user_detail(self):
+        url = reverse('qanda:user-detail', kwargs={
+            'username': self.owner.username})
+        for tab in (None, 'questions', 'answers'):
+            with self.subTest(tab=tab):
+                cache.delete_pattern('*')
+                self.assertBudget(6, 5, url,
+                                  data={'tab': tab} if tab else {})
+
+    def test_search(self):
+        self.assertBudget(2, 5,
+                          reverse('qanda:question_search'),
+                          data={'q': 'python django'})
+
+    def test_ask_question(self):
+        self.assertBudget(2, 0, reverse('qanda:ask_question'),
+                          user=self.owner)
+        self.assertBudget(
+            12, 10, reverse('qanda:ask_question'), method='post',
+            user=self.owner, data={
+                'user': self.owner.pk, 'title': 'Budget', 'body': 'Body',
+                'custom_tags': 'python, budget', 'action': 'SAVE'})
+
+    def test_question_vote_forms(self):
+        url = reverse('qanda:question_vote_create', kwargs={
+            'question_id': self.question.pk})
+        data = {'question': self.question.pk, 'value': 1}
+        self.assertBudget(11, 7, url, method='post',
+                          user=self.visitor, data=data)
+        vote = QuestionVote.objects.get(user=self.visitor,
+                                        question=self.question)
+        url = reverse('qanda:question_vote_update', kwargs={
+            'question_id': self.question.pk, 'pk': vote.pk})
+        data['value'] = -1
+        self.assertBudget(13, 4, url, method='post',
+                          data=data)
+
+    def test_answer_vote_forms(self):
+        url = reverse('qanda:answer_vote_create', kwargs={
+            'answer_id': self.answer.pk})
+        data = {'answer': self.answer.pk, 'value': 1}
+        self.assertBudget(14, 10, url, method='post',
+                          user=self.visitor, data=data)
+        vote = AnswerVote.objects.get(user=self.visitor, answer=self.answer)
+        url = reverse('qanda:answer_vote_update', kwargs={
+            'answer_id': self.answer.pk, 'pk': vote.pk})
+        data['value'] = -1
+        self.assertBudget(16, 5, url,
+                          method='post', data=data)
+
+    def test_vote_json(self):
+        self.assertBudget(
+            7, 7, reverse('qanda:question_vote_json', kwargs={
+                'pk': self.question.pk}),
+            method='post', user=self.visitor, data={'value': 1})
+        self.assertBudget(
+            9, 9,
+            reverse('qanda:answer_vote_json', kwargs={'pk': self.answer.pk}),
+            method='post', data={'value': -1})
+
+    def test_answer_create(self):
+        self.assertBudget(
+            10, 12, reverse('qanda:answer-create', kwargs={
+                'question_id': self.question.pk}),
+            method='post', user=self.visitor, data={
+                'question': self.question.pk, 'body': 'Budget answer'})
+
+    def test_answer_acceptance(self):
+        self.assertBudget(
+            7, 10, reverse('qanda:update_accepted_answer', kwargs={
+                'pk': self.answer.pk}),
+            method='post', user=self.owner, data={'accepted': True})
+
+    def test_subscriptions(self):
+        self.assertBudget(
+            8, 0,
+            reverse('qanda:question_subscription_create', kwargs={
+                'pk': self.question.pk}),
+            method='post', user=self.visitor, data={
+                'user': self.visitor.pk, 'question': self.question.pk,
+                'delivery': QuestionSubscription.DAILY})
+        self.assertBudget(
+            5, 0,
+            reverse('qanda:question_subscription_delete', kwargs={
+                'pk': self.question.pk}), method='post')
+
+    @override_settings(METRICS_TOKEN='budget')
+    def test_metrics(self):
+        self.assertBudget(0, 0, reverse('qanda:metrics'),
+                          HTTP_AUTHORIZATION='Bearer budget')
+
+    def test_activate(self):
+        user = User().objects.create(username='inactive', is_active=False)
+        self.assertBudget(13, 0, reverse('qanda:activate', kwargs={
+            'uidb64': urlsafe_base64_encode(force_bytes(user.pk)),
+            'token': account_activation_token.make_token(user)}))
+
+
+class CounterSignalTests(TestCase):
+    """ Vote and answer signals keep the denormalized columns in step """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User().objects.create(username='owner')
+        cls.author = User().objects.create(username='author')
+        cls.voter = User().objects.create(username='voter')
+        question = Question.objects.create(
+            user=cls.owner, title='Question', body='Body')
+        with mock.patch('qanda.tasks.build_new_answer_email.delay'):
+            Answer.objects.create(
+                user=cls.author, question=question, body='Answer')
+
+    def setUp(self):
+        # Deleted by some tests, and Django 2.2 shares class attributes
+        self.question = Question.objects.get()
+        self.answer = Answer.objects.get()
+
+    def assertCounters(self, score=0, answer_count=1, answers_score=0,
+                       answer_score=0, reputation=0):
+        question = Question.objects.get(pk=self.question.pk)
+        self.assertEqual(question.score, score)
+        self.assertEqual(question.answer_count, answer_count)
+        self.assertEqual(question.answers_score, answers_score)
+        for value in Answer.objects.filter(pk=self.answer.pk) \
+                .values_list('score', flat=True):
+            self.assertEqual(value, answer_score)
+        self.assertEqual(
+            Profile.objects.get(user=self.author).reputation, reputation)
+
+    def test_question_vote_create_flip_delete(self):
+        vote = QuestionVote.objects.create(
+            user=self.voter, question=self.question, value=QuestionVote.UP)
+        self.assertCounters(score=1)
+        vote.value = QuestionVote.DOWN
+        vote.save()
+        self.assertCounters(score=-1)
+        vote.save()
+        self.assertCounters(score=-1)
+        vote.delete()
+        self.assertCounters()
+
+    def test_answer_vote_create_flip_delete(self):
+        vote = AnswerVote.objects.create(
+            user=self.voter, answer=self.answer, value=AnswerVote.UP)
+        self.assertCounters(answers_score=1, answer_score=1, reputation=1)
+        vote.value = AnswerVote.DOWN
+        vote.save()
+        self.assertCounters(answers_score=-1, answer_score=-1, reputation=-1)
+        vote.delete()
+        self.assertCounters()
+
+    def test_answer_delete_takes_its_votes_along(self):
+        AnswerVote.objects.create(
+            user=self.voter, answer=self.answer, value=AnswerVote.UP)
+        self.answer.delete()
+        self.assertCounters(answer_count=0)
+
+    def test_answer_delete_with_a_drifted_count(self):
+        Question.objects.filter(pk=self.question.pk).update(answer_count=0)
+        self.answer.delete()
+        self.assertCounters(answer_count=-1)
+        call_command('reconcile_scores', stdout=StringIO())
+        self.assertCounters(answer_count=0)
+
+    def test_question_delete_cascades(self):
+        AnswerVote.objects.create(
+            user=self.voter, answer=self.answer, value=AnswerVote.UP)
+        QuestionVote.objects.create(
+            user=self.author, question=self.question, value=QuestionVote.UP)
+        self.question.delete()
+        self.assertFalse(Answer.objects.filter(pk=self.answer.pk).exists())
+        self.assertEqual(
+            Profile.objects.get(user=self.author).reputation, 0)
+
+
+class AcceptedAnswerTests(TestCase):
+    """ Only one answer of a question can be accepted at a time """
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User().objects.create(username='owner')
+        question = Question.objects.create(user=owner, title='Question',
+                                           body='Body')
+        with mock.patch('qanda.tasks.build_new_answer_email.delay'):
+            for number in range(3):
+                Answer.objects.create(user=owner, question=question,
+                                      body=f'Answer {number}')
+
+    def setUp(self):
+        self.answers = list(Answer.objects.order_by('pk'))
+
+    def accepted(self):
+        return list(Answer.objects.filter(accepted=True)
+                    .values_list('pk', flat=True))
+
+    def test_accepting_switches_the_accepted_answer(self):
+        first, second, _ = self.answers
+        Answer.objects.set_accepted(first, True)
+        Answer.objects.set_accepted(second, True)
+        self.assertEqual(self.accepted(), [second.pk])
+        Answer.objects.set_accepted(second, False)
+        self.assertEqual(self.accepted(), [])
+
+    def test_accepting_retries_after_a_concurrent_accept(self):
+        first, second, _ = self.answers
+        Answer.objects.filter(pk=first.pk).update(accepted=True)
+        clear_accepted = Answer.objects.clear_accepted
+        cleared = []
+
+        def clear_accepted_once_committed(question_id, exclude_id=None):
+            # The first clearing UPDATE runs before the concurrent accept
+            # of `first` commits and misses it
+            cleared.append(clear_accepted(question_id, exclude_id)
+                           if cleared else 0)
+            return cleared[-1]
+
+        with mock.patch.object(Answer.objects, 'clear_accepted',
+                               clear_accepted_once_committed):
+            Answer.objects.set_accepted(second, True)
+        self.assertEqual(cleared, [0, 1])
+        self.assertEqual(self.accepted(), [second.pk])
+
+
+@skipUnless(connection.vendor == 'postgresql', 'upsert_vote is Postgres')
+@override_settings(
+    CACHES={'default': dict(settings.CACHES['default'],
+                            KEY_PREFIX='qanda-tests')})
+class VoteUpsertTests(TestCase):
+    """ The single statement votes of the JSON endpoints """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User().objects.create(username='author')
+        cls.voter = User().objects.create(username='voter')
+        question = Question.objects.create(user=cls.author, title='Question',
+                                           body='Body')
+        with mock.patch('qanda.tasks.build_new_answer_email.delay'):
+            Answer.objects.create(user=cls.author, question=question,
+                                  body='Answer')
+
+    def setUp(self):
+        self.question = Question.objects.get()
+        self.answer = Answer.objects.get()
+        patcher = mock.patch('qanda.service.metrics.flush')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_upsert_vote_deltas(self):
+        upsert = QuestionVote.objects.upsert_vote
+        pk, user_id = self.question.pk, self.voter.pk
+        self.assertEqual(upsert(pk, user_id, QuestionVote.UP), 1)
+        self.assertEqual(upsert(pk, user_id, QuestionVote.UP), 0)
+        self.assertEqual(upsert(pk, user_id, QuestionVote.DOWN), -2)
+        self.assertEqual(
+            list(QuestionVote.objects.values_list('value', flat=True)),
+            [QuestionVote.DOWN])
+
+    def test_answer_vote_json(self):
+        self.client.force_login(self.voter)
+        url = reverse('qanda:answer_vote_json', kwargs={'pk': self.answer.pk})
+        for value, score in ((1, 1), (-1, -1), (-1, -1)):
+            with self.subTest(value=value):
+                response = self.client.post(url, {'value': value})
+                self.assertEqual(response.json(),
+                                 {'score': score, 'value': value})
+                self.assertEqual(
+                    Answer.objects.get(pk=self.answer.pk).score, score)
+                self.assertEqual(
+                    Question.objects.get(pk=self.question.pk).answers_score,
+                    score)
+                self.assertEqual(
+                    Profile.objects.get(user=self.author).reputation, score)
+        self.assertEqual(AnswerVote.objects.count(), 1)
+
+
+@override_settings(
+    ES_FAKE=True, SEARCH_PAGE_SIZE=2,
+    CACHES={'default': dict(settings.CACHES['default'],
+                            KEY_PREFIX='qanda-tests')})
+class SearchViewTests(TestCase):
+    """ Filters and search_after cursors of the search page """
+
+    @classmethod
+    def setUpTestData(cls):
+        fake_elasticsearch.reset()
+        elasticsearch._client = None
+        user = User().objects.create(username='searcher')
+        tags = {tag.name: tag for tag in
+                Tag.objects.get_or_create_many(['python', 'django'])}
+        for score in range(5):
+            question = Question.objects.create(
+                user=user, title=f'Python question {score}', body='Body')
+            question.tags.add(tags['python' if score % 2 else 'django'])
+            # save() stamps the creation date, set both columns directly
+            Question.objects.filter(pk=question.pk).update(
+                score=score, created=timezone.now() - timedelta(days=score))
+        cls.questions = list(Question.objects.order_by('score'))
+        elasticsearch.bulk_load(cls.questions)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        fake_elasticsearch.reset()
+        elasticsearch._client = None
+
+    def setUp(self):
+        cache.delete_pattern('*')
+        patcher = mock.patch('qanda.service.metrics.flush')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def search(self, url=None, **params):
+        response = self.client.get(
+            url or reverse('qanda:question_search'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.context
+
+    def ids(self, ctx):
+        return [question.id for question in ctx['questions']]
+
+    def test_cursors_walk_the_pages_both_ways(self):
+        by_score = [q.id for q in reversed(self.questions)]
+        first = self.search(q='python', sort='score')
+        self.assertEqual(self.ids(first), by_score[:2])
+        self.assertIsNone(first['previous_url'])
+
+        url = reverse('qanda:question_search')
+        second = self.search(url + first['next_url'])
+        self.assertEqual(self.ids(second), by_score[2:4])
+        last = self.search(url + second['next_url'])
+        self.assertEqual(self.ids(last), by_score[4:])
+        self.assertIsNone(last['next_url'])
+
+        back = self.search(url + last['previous_url'])
+        self.assertEqual(self.ids(back), by_score[2:4])
+        self.assertIn('sort=score', back['next_url'])
+
+    def test_tag_and_date_filters(self):
+        ctx = self.search(q='python', tags='Python', sort='newest')
+        self.assertEqual(self.ids(ctx), [self.questions[1].id,
+                                         self.questions[3].id])
+        created = timezone.localdate(self.questions[2].created)
+        ctx = self.search(q='python', created_from=created,
+                          created_to=created)
+        self.assertEqual(self.ids(ctx), [self.questions[2].id])
+
+    @override_settings(TIME_ZONE='America/Santo_Domingo')
+    def test_date_filters_use_the_local_day(self):
+        # 23:30 in Santo Domingo is already the next day in UTC
+        late = timezone.make_aware(datetime(2020, 3, 1, 23, 30))
+        question = self.questions[0]
+        Question.objects.filter(pk=question.pk).update(created=late)
+        elasticsearch.bulk_load(Question.objects.filter(pk=question.pk))
+        self.addCleanup(elasticsearch.bulk_load, [question])
+        for day, expected in ((date(2020, 3, 1), [question.id]),
+                              (date(2020, 3, 2), [])):
+            with self.subTest(day=day):
+                ctx = self.search(q='python', created_from=day,
+                                  created_to=day)
+                self.assertEqual(self.ids(ctx), expected)
+
+    def test_fake_sorts_missing_values_last(self):
+        hits = [{'_id': str(pk), '_score': 1.0, '_source': source}
+                for pk, source in enumerate([{'score': 1}, {}, {'score': 2},
+                                             {'score': None}])]
+        for order, expected in (('asc', ['0', '2', '1', '3']),
+                                ('desc', ['2', '0', '1', '3'])):
+            with self.subTest(order=order):
+                sort = [{'score': order}, {'id': 'asc'}]
+                self.assertEqual(
+                    [hit['_id'] for hit in
+                     fake_elasticsearch.sort_hits(hits, sort)], expected)
+
+    def test_invalid_cursor_gives_the_first_page(self):
+        ctx = self.search(q='python', sort='score', after='not-a-cursor')
+        self.assertEqual(self.ids(ctx), [self.questions[4].id,
+                                         self.questions[3].id])
+
+
+@skipUnless('django_redis' in settings.CACHES['default']['BACKEND'],
+            'the services talk to Redis directly')
+@override_settings(ES_FAKE=True, CACHES=REDIS_TEST_CACHES)
+class RedisServiceTests(TestCase):
+    """ View counts, search outbox, digests and reindexing through Redis """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User().objects.create(username='owner',
+                                         email='owner@example.com')
+        for number in range(3):
+            Question.objects.create(user=cls.user, title=f'Question {number}',
+                                    body='Body')
+
+    def setUp(self):
+        self.redis = get_redis_connection('default')
+        self.redis.flushdb()
+        fake_elasticsearch.reset()
+        elasticsearch._client = None
+        self.addCleanup(fake_elasticsearch.reset)
+        run_on_commit(self)
+        self.questions = list(Question.objects.order_by('pk'))
+
+    def outbox(self):
+        return {int(question_id) for question_id
+                in self.redis.zrange(search_outbox.OUTBOX_KEY, 0, -1)}
+
+    def test_view_flush_leaves_modified_and_the_index_alone(self):
+        question = self.questions[0]
+        self.assertTrue(view_counter.record_view(question.pk, 'visitor'))
+        self.assertFalse(view_counter.record_view(question.pk, 'visitor'))
+        view_counter.record_view(question.pk, 'other')
+        view_counter.record_view(self.questions[1].pk, 'visitor')
+
+        self.assertEqual(view_counter.flush_views(), 3)
+        self.assertEqual(view_counter.flush_views(), 0)
+        flushed = Question.objects.get(pk=question.pk)
+        self.assertEqual(flushed.viewed, question.viewed + 2)
+        self.assertEqual(flushed.modified, question.modified)
+        self.assertEqual(self.outbox(), set())
+
+    def test_outbox_coalesces_writes_and_drains(self):
+        question = self.questions[0]
+        question.save()
+        question.save()
+        missing_id = self.questions[-1].pk + 1000
+        search_outbox.enqueue(missing_id)
+        self.assertEqual(self.outbox(), {question.pk, missing_id})
+
+        self.assertEqual(search_outbox.drain(), 2)
+        self.assertEqual(self.outbox(), set())
+        indexed = dict(elasticsearch.scan_indexed(0))
+        self.assertEqual(set(indexed), {question.pk})
+
+    def test_outbox_requeues_when_indexing_fails(self):
+        first, second = self.questions[:2]
+        search_outbox.enqueue_many([first.pk, second.pk])
+        dirty_since = self.redis.zscore(search_outbox.OUTBOX_KEY, first.pk)
+        with mock.patch('qanda.service.elasticsearch.bulk_sync',
+                        side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                search_outbox.drain()
+        self.assertEqual(self.outbox(), {first.pk, second.pk})
+        self.assertEqual(
+            self.redis.zscore(search_outbox.OUTBOX_KEY, first.pk),
+            dirty_since)
+
+        with mock.patch('qanda.service.elasticsearch.bulk_sync',
+                        return_value={second.pk}):
+            self.assertEqual(search_outbox.drain(), 1)
+        self.assertEqual(self.outbox(), {second.pk})
+
+    def test_digest_pops_the_events_once(self):
+        first, second = self.questions[:2]
+        subscriber = [(self.user.pk, QuestionSubscription.DAILY)]
+        answer_digest.add_new_answer(first.pk, subscriber)
+        answer_digest.add_new_answer(first.pk, subscriber)
+        answer_digest.add_new_answer(second.pk, subscriber)
+
+        self.assertEqual(
+            answer_digest.send_digests(QuestionSubscription.DAILY), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.user.email])
+        self.assertIn(f"'{first.title}': 2 new answers", mail.outbox[0].body)
+        self.assertIn(f"'{second.title}': 1 new answer,", mail.outbox[0].body)
+        self.assertEqual(
+            answer_digest.send_digests(QuestionSubscription.DAILY), 0)
+
+    def test_digest_events_are_restored_when_sending_fails(self):
+        question = self.questions[0]
+        answer_digest.add_new_answer(
+            question.pk, [(self.user.pk, QuestionSubscription.DAILY)])
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend'
+                        '.send_messages', side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                answer_digest.send_digests(QuestionSubscription.DAILY)
+        self.assertEqual(
+            answer_digest.pop_events(QuestionSubscription.DAILY, 10),
+            {self.user.pk: {question.pk: 1}})
+
+    def reindex(self, checkpoint=None, **options):
+        """ Run the reindex command, from `checkpoint` when given """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'reindex.json')
+        if checkpoint is not None:
+            with open(path, 'w') as checkpoint_file:
+                json.dump(checkpoint, checkpoint_file)
+        command = ('qanda.management.commands'
+                   '.load_questions_into_elastic_search')
+        with mock.patch(f'{command}.Pool', SerialPool), \
+                mock.patch(f'{command}.connections'):
+            call_command('load_questions_into_elastic_search',
+                         resume=checkpoint is not None, reindex=True,
+                         checkpoint=path, workers=1, stdout=StringIO(),
+                         **options)
+        self.assertFalse(os.path.exists(path))
+
+    def resumable(self):
+        """ A checkpoint with the first question's range already loaded """
+        index = f'{settings.ES_INDEX}-resumed'
+        elasticsearch.create_index(index)
+        return {'index': index, 'range_size': self.questions[1].pk,
+                'created': True, 'done': [0]}
+
+    def alias_targets(self):
+        return set(elasticsearch.get_client().indices.get_alias(
+            name=settings.ES_INDEX))
+
+    def test_reindex_replays_the_writes_made_during_the_load(self):
+        self.redis.sadd(search_outbox.REINDEX_IDS_KEY, 999999)
+        search_outbox.start_capture()
+        self.assertGreater(self.redis.ttl(search_outbox.REINDEX_FLAG_KEY), 0)
+        self.assertFalse(self.redis.exists(search_outbox.REINDEX_IDS_KEY))
+        written = self.questions[0]
+        search_outbox.capture([written.pk])
+        self.assertGreater(self.redis.ttl(search_outbox.REINDEX_IDS_KEY), 0)
+
+        checkpoint = self.resumable()
+        self.reindex(checkpoint)
+        indexed = dict(elasticsearch.scan_indexed(0))
+        self.assertEqual(set(indexed),
+                         {question.pk for question in self.questions[1:]})
+        self.assertEqual(self.alias_targets(), {checkpoint['index']})
+        self.assertEqual(self.outbox(), {written.pk})
+        self.assertFalse(self.redis.exists(search_outbox.REINDEX_FLAG_KEY))
+
+    def test_reindex_resume_keeps_the_checkpoint_range_size(self):
+        with self.assertRaises(CommandError):
+            self.reindex(self.resumable(), range_size=5)
+
+    def test_reindex_reconciles_once_the_capture_expired(self):
+        # Nothing recorded the first question while the reindex was down,
+        # it is missing from the new index since its range was done
+        self.reindex(self.resumable())
+        self.assertEqual(self.outbox(), {self.questions[0].pk})
+
+    def test_fresh_reindex_loads_everything(self):
+        self.redis.sadd(search_outbox.REINDEX_IDS_KEY, 999999)
+        self.reindex()
+        indexed = dict(elasticsearch.scan_indexed(0))
+        self.assertEqual(set(indexed),
+                         {question.pk for question in self.questions})
+        self.assertEqual(self.outbox(), set())
+
+    def test_find_drift(self):
+        now = timezone.now()
+        stored = {1: (now, 3), 2: (now, 3), 3: (now, 3), 4: (now, 0)}
+        indexed = {1: (now.isoformat(), 3),
+                   2: ((now - timedelta(seconds=1)).isoformat(), 3),
+                   3: (now.isoformat(), 2),
+                   5: (now.isoformat(), 0)}
+        self.assertEqual(search_reconciler.find_drift(indexed, stored),
+                         {2, 3, 4, 5})
+
+    def test_reconciler_queues_the_drifted_questions(self):
+        orphan = Question.objects.create(user=self.user, title='Orphan',
+                                         body='Body')
+        elasticsearch.bulk_load(self.questions + [orphan])
+        first, second, third = self.questions
+        Question.objects.filter(pk=first.pk).update(score=5)
+        Question.objects.filter(pk=second.pk) \
+            .update(modified=F('modified') + timedelta(minutes=1))
+        elasticsearch.bulk_sync([], [third.pk])
+        orphan_id = orphan.pk
+        orphan.delete()
+        self.redis.delete(search_outbox.OUTBOX_KEY)
+
+        self.assertEqual(search_reconciler.reconcile(chunk_size=2), 4)
+        self.assertEqual(self.outbox(),
+                         {first.pk, second.pk, third.pk, orphan_id})
+
+    def test_metrics_flush_at_most_once_per_interval(self):
+        with mock.patch('qanda.service.metrics.flush') as flush, \
+                mock.patch('qanda.service.metrics._last_flush', None):
+            self.assertTrue(metrics.maybe_flush())
+            self.assertFalse(metrics.maybe_flush())
+            with override_settings(METRICS_FLUSH_INTERVAL=0):
+                self.assertTrue(metrics.maybe_flush())
+        self.assertEqual(flush.call_count, 2)
+
+    def test_metrics_are_kept_when_the_flush_fails(self):
+        labels = {'view': 'flush-test', 'cache': 'question', 'result': 'hit'}
+        metrics.CACHE_REQUESTS.inc(2, **labels)
+        with mock.patch('redis.client.Pipeline.execute',
+                        side_effect=ConnectionError):
+            metrics.flush()
+        self.assertFalse(self.redis.exists(metrics.METRICS_KEY))
+        metrics.CACHE_REQUESTS.inc(1, **labels)
+
+        metrics.flush()
+        stored = metrics.stored_values()[metrics.CACHE_REQUESTS.name]
+        self.assertEqual(
+            stored[metrics.CACHE_REQUESTS.label_values(labels)], {'': 3})
+
+
+@override_settings(PROFILE_TOKEN='profile', PROFILE_SAMPLE_RATE=0)
+class ProfilingMiddlewareTests(SimpleTestCase):
+    """ Requests profiled whatever the sample rate """
+
+    def test_only_the_token_forces_a_profile(self):
+        middleware = ProfilingMiddleware(None)
+        for header, profiled in (('profile', True), ('profil', False),
+                                 ('profile ', False), (None, False)):
+            with self.subTest(header=header):
+                extra = {} if header is None else {'HTTP_X_PROFILE': header}
+                request = RequestFactory().get('/', **extra)
+                self.assertIs(middleware.should_profile(request), profiled)
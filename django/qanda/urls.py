@@ -9,6 +9,8 @@ urlpatterns = [
          views.QuestionVoteCreate.as_view(), name='question_vote_create'),
     path('question/<int:question_id>/vote/<int:pk>/',
          views.QuestionVoteUpdate.as_view(), name='question_vote_update'),
+    path('question/<int:pk>/vote.json',
+         views.QuestionVoteJson.as_view(), name='question_vote_json'),
     path('question/<int:question_id>/answer/',
          views.AnswerCreate.as_view(), name='answer-create'),
     path('question/<int:pk>/<str:title>/',
@@ -17,6 +19,8 @@ urlpatterns = [
          views.AnswerVoteCreate.as_view(), name='answer_vote_create'),
     path('answer/<int:answer_id>/vote/<int:pk>/',
          views.AnswerVoteUpdate.as_view(), name='answer_vote_update'),
+    path('answer/<int:pk>/vote.json',
+         views.AnswerVoteJson.as_view(), name='answer_vote_json'),
     path('answer/<int:pk>/', views.UpdateAnswerAcceptanceView.as_view(),
          name='update_accepted_answer'),
     re_path(r'^activate/(?P<uidb64>[0-9A-Za-z_\-]+)/(?P<token>[0-9A-Za-z]{1,13}-[0-9A-Za-z]{1,20})/$',
@@ -24,6 +28,7 @@ urlpatterns = [
     path('users/<str:username>/',
          views.UserDetail.as_view(), name='user-detail'),
     path('q/search', views.SearchView.as_view(), name='question_search'),
+    path('metrics', views.metrics_view, name='metrics'),
     path('question/<int:pk>/subscribe',
          views.QuestionSubscriptionCreate.as_view(),
          name='question_subscription_create'),
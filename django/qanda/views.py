@@ -1,23 +1,34 @@
+import hmac
+
+from django.conf import settings
 from django.contrib.auth import get_user_model as User
 from django.contrib.auth import login
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.sites.shortcuts import get_current_site
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponseBadRequest
-from django.shortcuts import redirect, render
+from django.db import transaction
+from django.http import (HttpResponse, HttpResponseBadRequest,
+                         HttpResponseForbidden, JsonResponse)
+from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
 from django.urls import reverse, reverse_lazy
 from django.utils.encoding import force_bytes, force_text
 from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
 from django.views.generic import (CreateView, DeleteView, DetailView, ListView,
-                                  TemplateView, UpdateView)
+                                  TemplateView, UpdateView, View)
 from qanda.forms import (AnswerAcceptanceForm, AnswerForm, AnswerVoteForm,
                          CustomUserCreationForm, QuestionForm,
-                         QuestionVoteForm, QuestionSubscriptionForm)
-from qanda.mixins import CacheVaryOnCookieMixin
+                         QuestionVoteForm, QuestionSubscriptionForm,
+                         SearchForm)
+from qanda.pagination import KeysetPaginator, decode_key, encode_key
 from qanda.models import (Answer, AnswerVote, Profile, Question, QuestionVote,
-                          Tag, QuestionSubscription)
-from qanda.service.elasticsearch import search_for_questions
+                          Tag, QuestionSubscription, Votable,
+                          bump_answer_vote_versions,
+                          bump_question_vote_versions)
+from qanda.service import (fragment_cache, metrics, search_cache,
+                           task_metrics, view_counter)
+from qanda.service.elasticsearch import SEARCH_SORTS, search_for_questions
 from qanda.tokens import account_activation_token
 
 
@@ -35,18 +46,12 @@ class CreateQuestion(LoginRequiredMixin, CreateView):
     def form_valid(self, form):
         action = self.request.POST.get('action')
         if action == 'SAVE':
-            question = form.save()
-            for tag in form.custom_tags:
-                try:
-                    tag_model = Tag.objects.get(name=tag)
-                except Tag.DoesNotExist:
-                    tag_model = Tag.objects.create(name=tag)
-                question.tags.add(tag_model)
-                tag_model.save()
-
-            question.save()
-            # Save and redirect as usual
-            return super().form_valid(form)
+            # A single save, so the question is indexed once on commit
+            with transaction.atomic():
+                self.object = form.save()
+                self.object.tags.add(
+                    *Tag.objects.get_or_create_many(form.custom_tags))
+            return redirect(self.get_success_url())
         elif action == 'PREVIEW':
             preview = Question(
                 title=form.cleaned_data['title'],
@@ -56,13 +61,38 @@ class CreateQuestion(LoginRequiredMixin, CreateView):
         return HttpResponseBadRequest()
 
 
+def with_fresh_markup(posts):
+    """ Re-render the stale bodies of `posts` before they are cached
+
+        A cached post keeps the state it was pickled in, so a stale one
+        would be re-rendered and written back on every cache hit.
+    """
+    for post in posts:
+        post.get_body_html()
+    return posts
+
+
 class QuestionDetail(DetailView):
     queryset = Question.objects.all_with_relations_and_score()
 
-    def get_vote_data(self, model, obj, url_id, create_url, update_url):
-        vote = model.objects.get_vote_or_unsaved_blank_vote(
-            obj_instance=obj,
-            vote_user=self.request.user)
+    # The question and its answers are shared by every user, the votes and
+    # subscription of the current user are added per request.
+    def get_object(self, queryset=None):
+        pk = self.kwargs['pk']
+        return fragment_cache.get_or_set(
+            'question', [f'question:{pk}'],
+            lambda: with_fresh_markup(
+                [super(QuestionDetail, self).get_object(queryset)])[0], pk)
+
+    def get_answers(self):
+        pk = self.object.id
+        return fragment_cache.get_or_set(
+            'answers', [f'answers:{pk}'],
+            lambda: with_fresh_markup(
+                list(Answer.objects.all_with_score()
+                     .filter(question=pk).select_related('user'))), pk)
+
+    def get_vote_data(self, vote, obj, url_id, create_url, update_url):
         if vote.id:
             vote_form_url = reverse(update_url, kwargs={
                 url_id: obj.id, 'pk': vote.id})
@@ -72,18 +102,18 @@ class QuestionDetail(DetailView):
 
         return {'instance': vote, 'url': vote_form_url}
 
+    def get_visitor(self):
+        if self.request.user.is_authenticated:
+            return f'user:{self.request.user.id}'
+        if self.request.session.session_key:
+            return f'session:{self.request.session.session_key}'
+        return f'ip:{self.request.META.get("REMOTE_ADDR")}'
+
     def get_context_data(self, **kwargs):
-        self.object.viewed += 1
-        self.object.save()
+        view_counter.record_view(self.object.id, self.get_visitor())
         ctx = super(QuestionDetail, self).get_context_data(**kwargs)
-        ctx['answers'] = []
-        answers = Answer.objects.all_with_score() \
-            .filter(question=self.object.id)
-
-        for ans in answers:
-            answer_dict = {}
-            answer_dict['info'] = ans
-            ctx['answers'].append(answer_dict)
+        answers = self.get_answers()
+        ctx['answers'] = [{'info': ans} for ans in answers]
 
         if self.object.can_accept_answers(self.request.user):
             ctx['accept_form'] = \
@@ -97,27 +127,31 @@ class QuestionDetail(DetailView):
                 ctx['subscribed'] = True
             else:
                 ctx['subscribed'] = False
+                ctx['delivery_choices'] = \
+                    QuestionSubscription.DELIVERY_CHOICES
 
             vote_data = self.get_vote_data(
-                QuestionVote, self.object, 'question_id',
+                QuestionVote.objects.get_vote_or_unsaved_blank_vote(
+                    obj_instance=self.object, vote_user=self.request.user),
+                self.object, 'question_id',
                 'qanda:question_vote_create',
                 'qanda:question_vote_update')
             vote_form = QuestionVoteForm(instance=vote_data['instance'])
             ctx['vote_form'] = vote_form
             ctx['vote_form_url'] = vote_data['url']
 
-            i = 0
-            for ans in answers:
-                answer_dict = {}
+            # All the user's answer votes come from a single query
+            answer_votes = \
+                AnswerVote.objects.get_votes_or_unsaved_blank_votes(
+                    obj_instances=answers, vote_user=self.request.user)
+            for ans, answer_dict in zip(answers, ctx['answers']):
                 ans_vote_data = self.get_vote_data(
-                    AnswerVote, ans, 'answer_id', 'qanda:answer_vote_create',
-                    'qanda:answer_vote_update')
+                    answer_votes[ans.id], ans, 'answer_id',
+                    'qanda:answer_vote_create', 'qanda:answer_vote_update')
 
                 answer_dict['vote_form'] = AnswerVoteForm(
                     instance=ans_vote_data['instance'])
                 answer_dict['vote_url'] = ans_vote_data['url']
-                ctx['answers'][i].update(answer_dict)
-                i += 1
 
             ctx['answer_form'] = AnswerForm()
             ctx['answer_form_url'] = reverse('qanda:answer-create', kwargs={
@@ -205,37 +239,110 @@ class AnswerVoteUpdate(LoginRequiredMixin, UpdateView):
         return redirect(to=self.get_success_url())
 
 
+class VoteJsonView(LoginRequiredMixin, View):
+    """ Cast a vote with one upsert and answer the new score as JSON
+
+        The voted object is locked first so the returned score is exact.
+        The form based vote views above remain as the no-JavaScript path.
+    """
+    raise_exception = True
+    model = None
+    vote_model = None
+    # Bumps the cached fragments showing the score, called with the vote
+    bump_versions = None
+    parent_fields = ('score', 'user_id')
+
+    def post(self, request, pk):
+        try:
+            value = int(request.POST.get('value'))
+        except (TypeError, ValueError):
+            value = None
+        if value not in (Votable.UP, Votable.DOWN):
+            return HttpResponseBadRequest()
+
+        with transaction.atomic():
+            obj = get_object_or_404(
+                self.model.objects.select_for_update()
+                .only(*self.parent_fields), pk=pk)
+            delta = self.vote_model.objects.upsert_vote(
+                obj.id, request.user.id, value)
+            if delta:
+                self.model.objects.apply_vote_delta(obj.id, delta)
+                self.bump_versions(self.vote_model(
+                    user=request.user, value=value,
+                    **{self.vote_model.objects.vote_model: obj}))
+        return JsonResponse({'score': obj.score + delta, 'value': value})
+
+
+class QuestionVoteJson(VoteJsonView):
+    model = Question
+    vote_model = QuestionVote
+    bump_versions = staticmethod(bump_question_vote_versions)
+
+
+class AnswerVoteJson(VoteJsonView):
+    model = Answer
+    vote_model = AnswerVote
+    bump_versions = staticmethod(bump_answer_vote_versions)
+    parent_fields = ('score', 'user_id', 'question_id')
+
+
 class UpdateAnswerAcceptanceView(LoginRequiredMixin, UpdateView):
     form_class = AnswerAcceptanceForm
-    queryset = Answer.objects.all()
+    queryset = Answer.objects.select_related('question')
+
+    def form_valid(self, form):
+        Answer.objects.set_accepted(
+            self.object, form.cleaned_data['accepted'])
+        return redirect(self.get_success_url())
 
     def get_success_url(self):
         return self.object.question.get_absolute_url()
 
 
-class HomePageView(CacheVaryOnCookieMixin, ListView):
+class HomePageView(ListView):
     template_name = 'qanda/homepage.html'
     model = Question
     paginate_by = 10
-    timeout = 60*2
+    # Column each sort pages on, each one has a matching (column, id) index
+    sort_fields = {
+        'top': 'score',
+        'newest': 'created',
+        'answered': 'answers_score',
+    }
 
     def get_context_data(self, **kwargs):
         ctx = super(HomePageView, self).get_context_data(**kwargs)
-        ctx['last_answers'] = Answer.objects.all() \
-            .order_by('-created')[:5]
-        ctx['top_users'] = Profile.objects.all_with_user_score() \
-            .order_by('-score')[:5]
+        ctx['last_answers'] = fragment_cache.get_or_set(
+            'last-answers', ['answers'],
+            lambda: list(Answer.objects.all()
+                         .select_related('question', 'user')
+                         .order_by('-created')[:5]))
+        ctx['top_users'] = fragment_cache.get_or_set(
+            'top-users', ['leaderboard'],
+            lambda: list(Profile.objects.top_by_reputation(5)))
         ctx['questions'] = ctx['object_list']
+        # An exact COUNT(*) on every page view is not worth it for a total
+        ctx['question_count'] = cache.get_or_set(
+            'qanda:questions:count', Question.objects.count,
+            settings.CACHE_TTL)
         return ctx
 
     def get_queryset(self):
-        sort_by = self.request.GET.get('sort', None)
-        qs = Question.objects.all_with_answer_score()
-        if (sort_by == 'answered'):
-            qs = qs.order_by('-ans_score')
-        elif (sort_by != 'newest'):
-            qs = qs.order_by("-score")
-        return qs
+        return Question.objects.all_with_answer_score()
+
+    def paginate_queryset(self, queryset, page_size):
+        sort_by = self.request.GET.get('sort', 'top')
+        paginator = KeysetPaginator(
+            queryset, self.sort_fields.get(sort_by, 'score'), page_size)
+        after = self.request.GET.get('after')
+        before = self.request.GET.get('before')
+        page = fragment_cache.get_or_set(
+            'home', ['questions'],
+            lambda: paginator.page(after=after, before=before),
+            paginator.sort_field, after, before)
+        is_paginated = page.has_next() or page.has_previous()
+        return (paginator, page, page.object_list, is_paginated)
 
 
 class SignUpView(CreateView):
@@ -278,43 +385,81 @@ def activate(request, uidb64, token):
         return render(request, 'qanda/account_activation_invalid.html')
 
 
-class UserDetail(CacheVaryOnCookieMixin, DetailView):
+class UserDetail(DetailView):
     model = User()
     slug_field = "username"
     slug_url_kwarg = "username"
     template_name = 'qanda/user_detail.html'
 
     def get_context_data(self, **kwargs):
-        user = User().objects.get(username=self.kwargs['username'])
         ctx = super(UserDetail, self).get_context_data(**kwargs)
         tab = self.request.GET.get('tab', None)
-
-        ctx['answers'] = Answer.objects.all_with_score() \
-            .filter(user=user).order_by('-score')
-        ctx['questions'] = \
-            Question.objects.all_with_relations_and_score() \
-            .filter(user=user).order_by('-score')
-
         # User entered no tab query or invalid quer
         if (tab == 'None' or (tab != 'questions' and tab != 'answers')):
-            ctx['answers'] = ctx['answers'][:5]
-            ctx['questions'] = ctx['questions'][:5]
-
+            tab = None
+        ctx.update(fragment_cache.get_or_set(
+            'user-detail', [f'user:{self.object.id}'],
+            lambda: self.get_posts(tab), self.object.id, tab))
         return ctx
 
+    def get_posts(self, tab):
+        user = self.object
+        answers = Answer.objects.all_with_score() \
+            .filter(user=user).select_related('question').order_by('-score')
+        questions = Question.objects.all_with_relations_and_score() \
+            .filter(user=user).order_by('-score')
+        if tab is None:
+            answers = answers[:5]
+            questions = questions[:5]
+        return {
+            'answers': list(answers),
+            'questions': list(questions),
+            'answer_count': user.answer_set.count(),
+            'question_count': user.question_set.count(),
+        }
+
 
-class SearchView(CacheVaryOnCookieMixin, TemplateView):
+class SearchView(TemplateView):
     template_name = 'qanda/search.html'
-    timeout = 60*20
+
+    def get_cursor(self, name, sort):
+        """ The sort values to search after from a cursor, None if invalid """
+        key = decode_key(self.request.GET.get(name, ''))
+        if key is None or len(key) != len(SEARCH_SORTS[sort]) or not all(
+                isinstance(value, (int, float, str)) for value in key):
+            return None
+        return key
+
+    def page_url(self, cursor_name, sort_values):
+        """ This search with the filters kept, at another cursor """
+        if sort_values is None:
+            return None
+        params = self.request.GET.copy()
+        for name in ('after', 'before', 'page'):
+            params.pop(name, None)
+        params[cursor_name] = encode_key(sort_values)
+        return f'?{params.urlencode()}'
 
     def get_context_data(self, **kwargs):
         query = self.request.GET.get('q', None)
-        ctx = super().get_context_data(query=query, **kwargs)
-        if query:
-            results = search_for_questions(query)
-            ctx['questions'] = [
-                Question.objects.all_with_answer_score().get(
-                    id=hit['id']) for hit in results]
+        form = SearchForm(self.request.GET)
+        ctx = super().get_context_data(query=query, form=form, **kwargs)
+        if query and form.is_valid():
+            sort = form.cleaned_data['sort']
+            results = search_cache.get_or_search(
+                search_for_questions, query,
+                tags=form.cleaned_data['tags'],
+                created_from=form.cleaned_data['created_from'],
+                created_to=form.cleaned_data['created_to'],
+                sort=sort,
+                after=self.get_cursor('after', sort),
+                before=self.get_cursor('before', sort))
+            # Hydrate the whole page at once, keeping the search order
+            ctx['questions'] = Question.objects.all_in_order(results.ids)
+            ctx['total'] = results.total
+            ctx['next_url'] = self.page_url('after', results.next_after)
+            ctx['previous_url'] = self.page_url(
+                'before', results.previous_before)
         return ctx
 
 
@@ -348,3 +493,14 @@ class QuestionSubscriptionDelete(LoginRequiredMixin, DeleteView):
 
     def get_success_url(self):
         return self.object.question.get_absolute_url()
+
+
+def metrics_view(request):
+    """ Prometheus scrape endpoint, closed until METRICS_TOKEN is set """
+    token = settings.METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not token or not hmac.compare_digest(
+            authorization.encode(), f'Bearer {token}'.encode()):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render() + task_metrics.render(),
+                        content_type='text/plain; version=0.0.4')